@@ -1,36 +1,666 @@
 import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+
+
+CDF_CACHE_SIZE = 2**28  # Memory cap (bytes) of the cumulative tables cached by a DMDP
+TABLE_BLOCK_SIZE = 2**24  # Target size (bytes) of the cumulative table of a block of states
+PREDECESSOR_PATCHES = 1 / 16  # Share of the states whose rows can be patched before the predecessor index is rebuilt
+CDF_LEVELS = 2**16 - 1  # Levels of the quantized cumulative tables
+
+# Storage types of a DMDP by precision. The value vectors and the accumulations
+# (p^T v, cumulative sums) stay in float64 whatever the precision.
+#   - 'transition': probabilities, 'index': next states (sparse successors and samples)
+#   - 'cdf': cumulative tables of the pairs, uint16 for tables quantized to CDF_LEVELS.
+#     The block tables of 'quantized' are uint32 keys (row of the pair in the block)
+#     * 2**16 + level: a successor whose probability is below about 1/CDF_LEVELS
+#     may never be drawn. Those of 'single' are float32 normalized cdfs by row.
+#   - 'policy': actions of the policies returned by the solvers
+PRECISIONS = {
+    'double': {'transition': np.float64, 'index': np.int64, 'cdf': np.float64, 'policy': np.float64},
+    'single': {'transition': np.float32, 'index': np.int32, 'cdf': np.float32, 'policy': np.int32},
+    'quantized': {'transition': np.float32, 'index': np.int32, 'cdf': np.uint16, 'policy': np.int16},
+}
+
+
+class Sparse_transition:
+    """ CSR-style storage of the transition probabilities of a DMDP.
+        The successors of (s, a) are indices[indptr[r]:indptr[r+1]], with
+        probabilities probs[indptr[r]:indptr[r+1]], where r = s*nb_a + a.
+        Memory scales with the number of nonzero transitions. """
+
+    def __init__(self, nb_s, nb_a, indptr, indices, probs):
+
+        self.nb_s = nb_s
+        self.nb_a = nb_a
+        self.indptr = np.asarray(indptr)  # size nb_s*nb_a + 1
+        self.indices = np.asarray(indices)  # next states
+        self.probs = np.asarray(probs)  # transition probabilities
+        assert(len(self.indptr) == nb_s * nb_a + 1)
+        assert(len(self.indices) == len(self.probs) == self.indptr[-1])
+
+    @classmethod
+    def from_dense(cls, P):
+        """ Build from a dense array P[state, action, next_state] """
+        nb_s, nb_a, _ = P.shape
+        P = P.reshape(nb_s * nb_a, nb_s)
+        rows, indices = np.nonzero(P)
+        indptr = np.zeros(nb_s * nb_a + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=nb_s * nb_a), out=indptr[1:])
+        return cls(nb_s, nb_a, indptr, indices, P[rows, indices])
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def row(self, state, action):
+        """ Successors of (state, action) and their probabilities """
+        r = state * self.nb_a + action
+        start, stop = self.indptr[r], self.indptr[r + 1]
+        return self.indices[start:stop], self.probs[start:stop]
+
+    def dot(self, v, start=0, stop=None):
+        """ p_a(i)^T v for the states start <= i < stop, size (stop - start) x nb_a """
+        if stop is None:
+            stop = self.nb_s
+        nb_rows = (stop - start) * self.nb_a
+        seg = self.indptr[start * self.nb_a:stop * self.nb_a + 1]
+        first, last = seg[0], seg[-1]
+        rows = np.repeat(np.arange(nb_rows), np.diff(seg))
+        weights = self.probs[first:last] * v[self.indices[first:last]]
+        res = np.bincount(rows, weights=weights, minlength=nb_rows)
+        return res.reshape(stop - start, self.nb_a)
+
+    def toarray(self):
+        """ Dense copy P[state, action, next_state], only for small MDPs """
+        P = np.zeros((self.nb_s * self.nb_a, self.nb_s))
+        rows = np.repeat(np.arange(self.nb_s * self.nb_a), np.diff(self.indptr))
+        np.add.at(P, (rows, self.indices), self.probs)
+        return P.reshape(self.nb_s, self.nb_a, self.nb_s)
 
 
 class DMDP:
 
-    def __init__(self, nb_a, nb_s, R, P, gamma=0.95):
+    def __init__(self, nb_a, nb_s, R, P, gamma=0.95, cdf_cache_size=CDF_CACHE_SIZE, M=None,
+                 precision=None):
+        """ - precision: key of PRECISIONS; the transitions are converted to its
+              types (copied if they differ), and kept as given if None, with the
+              tables and policies of 'double' """
 
         self.nb_a = nb_a
         self.nb_s = nb_s
         self.gamma = gamma
+        self.is_sparse = isinstance(P, Sparse_transition)
+        if precision is not None and precision not in PRECISIONS:
+            raise ValueError("Unknown precision '{}', should be in {}".format(precision, list(PRECISIONS)))
+        self.precision = 'double' if precision is None else precision
+        self.dtypes = PRECISIONS[self.precision]
+        if precision is not None and self.is_sparse:
+            P = Sparse_transition(nb_s, nb_a, P.indptr, np.asarray(P.indices, self.dtypes['index']),
+                                  np.asarray(P.probs, self.dtypes['transition']))
+        elif precision is not None:
+            P = np.asarray(P, self.dtypes['transition'])
+        if self.precision != 'double':
+            assert(nb_a <= np.iinfo(self.dtypes['policy']).max and nb_s <= np.iinfo(self.dtypes['index']).max)
 
         self.rewards = R  # R[state, action]
-        self.transition = P  # P[state, action, next_state]
-        self.M = int(np.max(np.abs(R))) + 1
+        self.transition = P  # P[state, action, next_state] or Sparse_transition
+        self.M = int(np.max(np.abs(R))) + 1 if M is None else M
+        self.nb_samples = 0  # Number of next states drawn from the generative model
+        self.nb_samples_hoeffding = 0  # Number the Hoeffding sample sizes of apx_trans ask for
+
+        # Cumulative tables of p_a(s), built lazily and evicted least recently used first
+        self.cdf_cache_size = cdf_cache_size
+        self._cdf_cache = OrderedDict()
+        self._cdf_cache_bytes = 0
+        row_size = P.nnz / (nb_s * nb_a) if self.is_sparse else nb_s
+        key_size = 8 if self.dtypes['cdf'] == np.float64 else 4
+        self.table_block = max(1, int(TABLE_BLOCK_SIZE // (key_size * nb_a * row_size)))
+        if self.dtypes['cdf'] == np.uint16:  # the row of a pair takes 16 bits of the keys
+            self.table_block = max(1, min(self.table_block, 2**16 // nb_a))
+        self._predecessors = None  # Predecessor index, built on demand
+        self._patched = {}  # successors of the states whose rows changed since, see invalidate
+        self._extra = {}  # predecessors of a state among the patched states
+
+    def astype(self, precision):
+        """ Copy of the DMDP with the storage types of precision (see PRECISIONS),
+            sharing the rewards """
+        return DMDP(self.nb_a, self.nb_s, self.rewards, self.transition, self.gamma,
+                    self.cdf_cache_size, self.M, precision)
+
+    def storage_bytes(self):
+        """ Memory taken by the transitions """
+        if self.is_sparse:
+            P = self.transition
+            return P.indptr.nbytes + P.indices.nbytes + P.probs.nbytes
+        return self.transition.nbytes
 
     def reset(self):
         return np.random.randint(0, nb_s)
 
+    def successors(self, state, action):
+        """ Possible next states of (state, action) and their probabilities """
+        if self.is_sparse:
+            return self.transition.row(state, action)
+        return np.arange(self.nb_s), self.transition[state, action, :]
+
     def step(self, state, action):
-        next_state = np.random.choice(self.nb_s, 1, p=self.transition[state, action, :])
+        next_state = self.step_batch(state, action, 1)[0]
         reward = self.rewards[state, action]
         return next_state[0], reward
 
+    def _cached(self, key, build):
+        """ Table stored under key in the cache, build() returns (table, size in bytes) """
+        entry = self._cdf_cache.get(key)
+        if entry is not None:
+            self._cdf_cache.move_to_end(key)
+            return entry[0]
+
+        table, size = build()
+        if size <= self.cdf_cache_size:
+            while self._cdf_cache_bytes + size > self.cdf_cache_size:
+                _, (_, old_size) = self._cdf_cache.popitem(last=False)
+                self._cdf_cache_bytes -= old_size
+            self._cdf_cache[key] = (table, size)
+            self._cdf_cache_bytes += size
+        return table
+
+    def _cdf(self, state, action):
+        """ Cumulative table of p_a(state): (next states or None if all, cdf) """
+        def build():
+            indices, probs = self.successors(state, action)
+            cdf = np.cumsum(probs, dtype=np.float64)
+            if self.dtypes['cdf'] == np.uint16:
+                cdf = np.rint(cdf / cdf[-1] * CDF_LEVELS)
+            cdf = cdf.astype(self.dtypes['cdf'])
+            return (indices if self.is_sparse else None, cdf), cdf.nbytes
+
+        return self._cached((state, action), build)
+
+    def _block_keys(self, block):
+        """ Cumulative tables of all the pairs of a block of table_block states.
+            The normalized cdf of the k-th pair of the block is shifted by k, so that
+            the whole block is increasing and can be searched at once.
+            - 'single': float32 normalized cdfs, not shifted (a float32 shift would
+              lose their resolution), searched row by row in _search_rows
+            - 'quantized': uint32 keys row*2**16 + level of the cdf quantized to
+              CDF_LEVELS, so the probabilities below about 1/CDF_LEVELS are lost
+            Return (next states or None if all, keys, row offsets in keys) """
+        start = block * self.table_block
+        stop = min(start + self.table_block, self.nb_s)
+        nb_rows = (stop - start) * self.nb_a
+
+        def build():
+            if self.is_sparse:
+                seg = self.transition.indptr[start * self.nb_a:stop * self.nb_a + 1]
+                offsets = seg - seg[0]
+                probs = self.transition.probs[seg[0]:seg[-1]]
+                indices = self.transition.indices[seg[0]:seg[-1]]
+            else:
+                offsets = np.arange(nb_rows + 1) * self.nb_s
+                probs = self.transition[start:stop].reshape(-1)
+                indices = None
+            rows = np.repeat(np.arange(nb_rows), np.diff(offsets))
+            cdf = np.cumsum(probs, dtype=np.float64)
+            base = np.concatenate(([0.], cdf))[offsets]
+            keys = (cdf - base[rows]) / np.diff(base)[rows]
+            if self.dtypes['cdf'] == np.float64:
+                keys += rows
+            elif self.dtypes['cdf'] == np.uint16:
+                keys = (rows.astype(np.uint32) << 16) | np.rint(keys * CDF_LEVELS).astype(np.uint32)
+            else:
+                keys = keys.astype(np.float32)
+            if self.dtypes['cdf'] != np.float64:
+                offsets = offsets.astype(self.dtypes['index'])
+            return (indices, keys, offsets), keys.nbytes + offsets.nbytes
+
+        return self._cached(('block', block), build)
+
+    def _search_block(self, block, rows, n, rng):
+        """ Draw n next states for each pair of rows (local rows of a block) """
+        indices, keys, offsets = self._block_keys(block)
+        u = rng.random((len(rows), n))
+        if keys.dtype == np.float32:
+            pos = self._search_rows(keys, offsets, rows, u)
+        else:
+            if keys.dtype == np.uint32:
+                targets = (rows.astype(np.uint32)[:, None] << 16) | (u * CDF_LEVELS).astype(np.uint32)
+            else:
+                targets = rows[:, None] + u
+            pos = np.searchsorted(keys, targets, side='right')
+        np.clip(pos, offsets[rows, None], offsets[rows + 1, None] - 1, out=pos)
+        return pos - offsets[rows, None] if indices is None else indices[pos]
+
+    @staticmethod
+    def _search_rows(keys, offsets, rows, u):
+        """ Position in keys of the first entry > u[k] of the segment of rows[k],
+            keys[offsets[r]:offsets[r + 1]] (as searchsorted side='right'), with a
+            binary search on all the segments at once """
+        lo = np.repeat(offsets[rows].astype(np.int64)[:, None], u.shape[1], axis=1)
+        hi = np.repeat(offsets[rows + 1].astype(np.int64)[:, None], u.shape[1], axis=1)
+        for _ in range(int(np.max(hi[:, 0] - lo[:, 0])).bit_length()):
+            mid = (lo + hi) // 2
+            right = (mid < hi) & (keys[np.minimum(mid, len(keys) - 1)] <= u)
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(right, hi, mid)
+        return lo
+
+    def step_batch(self, states, actions, n, rng=None):
+        """ Draw n next states for each pair (states[k], actions[k])
+            - states, actions: arrays of the same size (or scalars)
+            - rng: np.random.Generator, the global numpy generator by default
+            - return an array of size len(states) x n """
+        states, actions = np.broadcast_arrays(np.atleast_1d(states), np.atleast_1d(actions))
+        rng = np.random if rng is None else rng
+        u = rng.random((len(states), n))
+        next_states = np.empty((len(states), n), dtype=self.dtypes['index'])
+        self.nb_samples += len(states) * n
+
+        for k in range(len(states)):
+            indices, cdf = self._cdf(states[k], actions[k])
+            target = u[k] * cdf[-1]
+            if cdf.dtype == np.uint16:
+                target = target.astype(np.uint16)
+            pos = np.searchsorted(cdf, target, side='right')
+            np.minimum(pos, len(cdf) - 1, out=pos)
+            next_states[k] = pos if indices is None else indices[pos]
+
+        return next_states
+
+    def step_block(self, start, stop, n, rng=None):
+        """ Draw n next states for every pair (i, a) with start <= i < stop
+            - rng: np.random.Generator, the global numpy generator by default
+            - return an array of size (stop - start)*nb_a x n, row (i - start)*nb_a + a """
+        rng = np.random if rng is None else rng
+        next_states = np.empty(((stop - start) * self.nb_a, n), dtype=self.dtypes['index'])
+        self.nb_samples += (stop - start) * self.nb_a * n
+
+        for block in range(start // self.table_block, (stop - 1) // self.table_block + 1):
+            first = block * self.table_block
+            lo, hi = max(start, first), min(stop, first + self.table_block)
+            rows = np.arange((lo - first) * self.nb_a, (hi - first) * self.nb_a)
+            next_states[(lo - start) * self.nb_a:(hi - start) * self.nb_a] = \
+                self._search_block(block, rows, n, rng)
+
+        return next_states
+
+    def invalidate(self, states):
+        """ Forget the tables built from the transitions of states, after they changed
+            - the predecessor index is patched with the new rows of states, in
+              O(their number of successors), until PREDECESSOR_PATCHES of the
+              states are patched and it is rebuilt """
+        states = set(np.atleast_1d(states).tolist())
+        blocks = {s // self.table_block for s in states}
+        for key in list(self._cdf_cache):
+            if (key[1] in blocks) if key[0] == 'block' else (key[0] in states):
+                _, size = self._cdf_cache.pop(key)
+                self._cdf_cache_bytes -= size
+
+        if self._predecessors is None:
+            return
+        if len(states | set(self._patched)) > PREDECESSOR_PATCHES * self.nb_s:
+            self._predecessors, self._patched, self._extra = None, {}, {}
+            return
+        for i in states:
+            for s in self._patched.pop(i, ()):
+                del self._extra[s][i]
+            succ, probs = zip(*[self.successors(i, a) for a in range(self.nb_a)])
+            succ, probs = np.concatenate(succ), np.concatenate(probs)
+            succ, probs = succ[probs > 0], probs[probs > 0]
+            order = np.argsort(succ, kind='stable')
+            succ, first = np.unique(succ[order], return_index=True)
+            probs = np.maximum.reduceat(probs[order], first) if len(first) else probs
+            self._patched[i] = succ.tolist()
+            for s, p in zip(self._patched[i], probs.tolist()):
+                self._extra.setdefault(s, {})[i] = p
+
+    def predecessor_index(self):
+        """ Reverse index of the transitions, built once (rebuilt after invalidate
+            if rows were patched, see predecessors for a patched lookup): the
+            predecessors of state s are states[indptr[s]:indptr[s + 1]] (sorted,
+            the states i with p_a(i)[s] > 0 for some a), with max_a p_a(i)[s] in probs
+            - return indptr, states, probs """
+        if self._patched:
+            self._predecessors, self._patched, self._extra = None, {}, {}
+        if self._predecessors is None:
+            T = self.transition_matrix().T.tocsr()
+            T.sum_duplicates()
+            rows = np.repeat(np.arange(self.nb_s), np.diff(T.indptr))
+            states = T.indices // self.nb_a
+            first = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (states[1:] != states[:-1])])
+            first = first[first < len(rows)]
+            probs = np.maximum.reduceat(T.data, first) if len(first) else T.data[:0]
+            indptr = np.searchsorted(rows[first], np.arange(self.nb_s + 1))
+            self._predecessors = (indptr, states[first], probs)
+        return self._predecessors
+
+    def predecessors(self, state):
+        """ States i with p_a(i)[state] > 0 for some a, and max_a p_a(i)[state]
+            - the entries of the patched states (see invalidate) are taken from
+              their new rows instead of the index """
+        if self._predecessors is None:
+            self.predecessor_index()
+        indptr, states, probs = self._predecessors
+        states, probs = states[indptr[state]:indptr[state + 1]], probs[indptr[state]:indptr[state + 1]]
+        if not self._patched:
+            return states, probs
+
+        keep = np.array([i not in self._patched for i in states.tolist()], dtype=bool)
+        extra = self._extra.get(state, {})
+        return (np.concatenate([states[keep], np.fromiter(extra, dtype=states.dtype, count=len(extra))]),
+                np.concatenate([probs[keep], np.fromiter(extra.values(), dtype=float, count=len(extra))]))
+
+    def step_rows(self, rows, n, rng=None):
+        """ Draw n next states for each pair of rows (row i*nb_a + a, sorted)
+            - rng: np.random.Generator, the global numpy generator by default
+            - return an array of size len(rows) x n """
+        rows = np.asarray(rows)
+        rng = np.random if rng is None else rng
+        next_states = np.empty((len(rows), n), dtype=self.dtypes['index'])
+        self.nb_samples += len(rows) * n
+        if len(rows) == 0:
+            return next_states
+
+        block_rows = self.table_block * self.nb_a
+        first, last = rows[0] // block_rows, rows[-1] // block_rows
+        bounds = np.searchsorted(rows, np.arange(first, last + 2) * block_rows)
+        for block in range(first, last + 1):
+            lo, hi = bounds[block - first], bounds[block - first + 1]
+            if lo == hi:
+                continue
+            next_states[lo:hi] = self._search_block(block, rows[lo:hi] - block * block_rows, n, rng)
+
+        return next_states
+
+    def transition_matrix(self, states=None, actions=None):
+        """ Sparse matrix (scipy CSR) whose rows are the distributions p_a(i)
+            - states, actions: arrays of the pairs (i, a) of the rows, by default
+              all the pairs with row i*nb_a + a """
+        nb_rows = self.nb_s * self.nb_a
+        if states is None:
+            if self.is_sparse:
+                P = self.transition
+                return sp.csr_matrix((P.probs, P.indices, P.indptr), shape=(nb_rows, self.nb_s))
+            return sp.csr_matrix(np.asarray(self.transition).reshape(nb_rows, self.nb_s))
+
+        states, actions = np.broadcast_arrays(np.atleast_1d(states), np.atleast_1d(actions))
+        if not self.is_sparse:
+            return sp.csr_matrix(self.transition[states, actions, :])
+
+        P = self.transition
+        rows = states * self.nb_a + actions
+        counts = P.indptr[rows + 1] - P.indptr[rows]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        pos = np.repeat(P.indptr[rows] - indptr[:-1], counts) + np.arange(indptr[-1])
+        return sp.csr_matrix((P.probs[pos], P.indices[pos], indptr), shape=(len(rows), self.nb_s))
+
+    def expected_values(self, v, start=0, stop=None):
+        """ Expectations p_a(i)^T v for the states start <= i < stop
+            - v: value vector of size nb_s
+            - the transitions are read by blocks of table_block states, which
+              makes a sequential pass when they are memory-mapped
+            - return an array of size (stop - start) x nb_a """
+        if stop is None:
+            stop = self.nb_s
+        if stop - start > self.table_block:
+            return np.concatenate([self.expected_values(v, first, min(first + self.table_block, stop))
+                                   for first in range(start, stop, self.table_block)])
+
+        if self.is_sparse:
+            return self.transition.dot(v, start, stop)
+        return self.transition[start:stop].dot(v)
 
-def create_random_DMDP(nb_a, nb_s, reward_func, gamma=0.95):
+
+class Simulator_DMDP:
+    """
+    DMDP known only through a generative model: the transitions are never
+    materialized, next states are drawn by a user-supplied vectorized sampler.
+
+    It offers the sampling interface of DMDP (step, step_batch, step_block,
+    step_rows and the sample counters), so that the sampling-based solvers
+    (apx_trans, sublinear_time_randomized_VI, sublinear_random_mon_VI,
+    Randomized_Primal_Dual.from_DMDP) run on it unchanged. The methods and solvers
+    needing the probabilities (expected_values, successors, transition_matrix,
+    predecessors, value and policy iteration, high_precision_randomized_VI which
+    computes p^T v0 exactly, LP, Sweep_pool) raise a NotImplementedError.
+
+    - sample_next(states, actions, rng): next states of the pairs (states[k],
+      actions[k]) (integer arrays of the same size), drawn with the
+      np.random.Generator rng
+    - R: rewards R[state, action]
+    - M: bound on |R|, computed from R if None
+    """
+
+    is_sparse = False
+    precision = 'double'
+    dtypes = PRECISIONS['double']
+
+    def __init__(self, nb_a, nb_s, sample_next, R, gamma=0.95, M=None):
+
+        self.nb_a = nb_a
+        self.nb_s = nb_s
+        self.gamma = gamma
+        self.sample_next = sample_next
+        self.rewards = R
+        self.M = int(np.max(np.abs(R))) + 1 if M is None else M
+        self.nb_samples = 0
+        self.nb_samples_hoeffding = 0
+        # Blocks of states of a Sample_bank, as for a sparse DMDP with 8 successors
+        self.table_block = max(1, int(TABLE_BLOCK_SIZE // (64 * nb_a)))
+
+    def _missing(self, name):
+        return NotImplementedError(
+            "{} needs the transition probabilities, which a Simulator_DMDP does not have: "
+            "use a sampling-based solver (sublinear_time_randomized_VI, sublinear_random_mon_VI, "
+            "Randomized_Primal_Dual.from_DMDP)".format(name))
+
+    @property
+    def transition(self):
+        raise self._missing('transition')
+
+    def successors(self, state, action):
+        raise self._missing('successors')
+
+    def expected_values(self, v, start=0, stop=None):
+        raise self._missing('expected_values')
+
+    def transition_matrix(self, states=None, actions=None):
+        raise self._missing('transition_matrix')
+
+    def predecessor_index(self):
+        raise self._missing('predecessor_index')
+
+    def predecessors(self, state):
+        raise self._missing('predecessors')
+
+    def invalidate(self, states):
+        pass
+
+    def reset(self):
+        return np.random.randint(0, self.nb_s)
+
+    def step(self, state, action):
+        next_state = self.step_batch(state, action, 1)[0]
+        return next_state[0], self.rewards[state, action]
+
+    def step_batch(self, states, actions, n, rng=None):
+        """ Draw n next states for each pair (states[k], actions[k])
+            - rng: np.random.Generator, seeded from the global numpy generator by default
+            - return an array of size len(states) x n """
+        states, actions = np.broadcast_arrays(np.atleast_1d(states), np.atleast_1d(actions))
+        rng = np.random.default_rng(np.random.randint(2**31)) if rng is None else rng
+        self.nb_samples += len(states) * n
+        next_states = self.sample_next(np.repeat(states, n), np.repeat(actions, n), rng)
+        return np.asarray(next_states).reshape(len(states), n)
+
+    def step_block(self, start, stop, n, rng=None):
+        """ Draw n next states for every pair (i, a) with start <= i < stop
+            - return an array of size (stop - start)*nb_a x n, row (i - start)*nb_a + a """
+        return self.step_rows(np.arange(start * self.nb_a, stop * self.nb_a), n, rng)
+
+    def step_rows(self, rows, n, rng=None):
+        """ Draw n next states for each pair of rows (row i*nb_a + a)
+            - return an array of size len(rows) x n """
+        rows = np.asarray(rows)
+        return self.step_batch(rows // self.nb_a, rows % self.nb_a, n, rng)
+
+
+class Batched_DMDP:
+    """
+    B DMDPs of the same sizes nb_s and nb_a, solved together along a leading
+    batch axis (see run_batched_value_iteration, batched_high_precision_randomized_VI).
+
+    - R: rewards, size B x nb_s x nb_a
+    - P: transitions, size B x nb_s x nb_a x nb_s, or a Sparse_transition over
+      the B*nb_s states of the instances one after the other (row
+      (b*nb_s + i)*nb_a + a), whose next states are numbered within their instance
+    - gamma: discount of each instance (size B), or one for all
+    - see from_DMDPs to stack DMDPs
+    """
+
+    dtypes = PRECISIONS['double']
+
+    def __init__(self, nb_a, nb_s, R, P, gamma=0.95):
+
+        self.nb_a = nb_a
+        self.nb_s = nb_s
+        self.rewards = np.asarray(R)
+        self.nb_b = self.rewards.shape[0]
+        self.transition = P
+        self.is_sparse = isinstance(P, Sparse_transition)
+        self.gamma = np.broadcast_to(np.asarray(gamma, dtype=float), (self.nb_b,)).copy()
+        self.M = np.max(np.abs(self.rewards), axis=(1, 2)).astype(int) + 1
+        assert(self.rewards.shape == (self.nb_b, nb_s, nb_a))
+        if self.is_sparse:
+            assert(P.nb_s == self.nb_b * nb_s and P.nb_a == nb_a)
+        else:
+            assert(P.shape == (self.nb_b, nb_s, nb_a, nb_s))
+        self._instances = [None] * self.nb_b
+
+    @classmethod
+    def from_DMDPs(cls, mdps):
+        """ Stack DMDPs of the same sizes, all dense or all sparse """
+        nb_s, nb_a = mdps[0].nb_s, mdps[0].nb_a
+        assert(all(mdp.nb_s == nb_s and mdp.nb_a == nb_a for mdp in mdps))
+        R = np.stack([mdp.rewards for mdp in mdps])
+        gamma = [mdp.gamma for mdp in mdps]
+        if not mdps[0].is_sparse:
+            return cls(nb_a, nb_s, R, np.stack([mdp.transition for mdp in mdps]), gamma)
+
+        nnz = np.cumsum([0] + [mdp.transition.nnz for mdp in mdps])
+        indptr = np.concatenate([[0]] + [mdp.transition.indptr[1:] + first
+                                         for mdp, first in zip(mdps, nnz)])
+        P = Sparse_transition(len(mdps) * nb_s, nb_a, indptr,
+                              np.concatenate([mdp.transition.indices for mdp in mdps]),
+                              np.concatenate([mdp.transition.probs for mdp in mdps]))
+        return cls(nb_a, nb_s, R, P, gamma)
+
+    def instance(self, b):
+        """ DMDP of the instance b, sharing the arrays of the batch (its tables
+            of next states are built lazily, within CDF_CACHE_SIZE / B) """
+        if self._instances[b] is None:
+            if self.is_sparse:
+                rows = self.transition.indptr[b * self.nb_s * self.nb_a:(b + 1) * self.nb_s * self.nb_a + 1]
+                P = Sparse_transition(self.nb_s, self.nb_a, rows - rows[0],
+                                      self.transition.indices[rows[0]:rows[-1]],
+                                      self.transition.probs[rows[0]:rows[-1]])
+            else:
+                P = self.transition[b]
+            self._instances[b] = DMDP(self.nb_a, self.nb_s, self.rewards[b], P, self.gamma[b],
+                                      CDF_CACHE_SIZE // self.nb_b, M=self.M[b])
+        return self._instances[b]
+
+    @property
+    def nb_samples(self):
+        """ Next states drawn so far from the instances """
+        return sum(mdp.nb_samples for mdp in self._instances if mdp is not None)
+
+    def _chunks(self, active):
+        """ Chunks of the active instances of at most TABLE_BLOCK_SIZE bytes of
+            transitions (dense size), as a slice of the batch when they are
+            contiguous and as an index array otherwise """
+        size = 8 * self.nb_s * self.nb_a * (1 if self.is_sparse else self.nb_s)
+        step = max(1, TABLE_BLOCK_SIZE // size)
+        idx = np.flatnonzero(active)
+        for lo in range(0, len(idx), step):
+            inst = idx[lo:lo + step]
+            if inst[-1] - inst[0] == len(inst) - 1:
+                yield slice(inst[0], inst[-1] + 1), inst
+            else:
+                yield inst, inst
+
+    def _sparse_rows(self, sel, inst):
+        """ Positions in the sparse arrays of the rows of the instances inst,
+            and the row of each position within the chunk """
+        P = self.transition
+        nb_rows = self.nb_s * self.nb_a
+        if isinstance(sel, slice):
+            seg = P.indptr[sel.start * nb_rows:sel.stop * nb_rows + 1]
+            return np.arange(seg[0], seg[-1]), np.repeat(np.arange(len(inst) * nb_rows), np.diff(seg))
+        rows = (inst[:, None] * nb_rows + np.arange(nb_rows)).ravel()
+        counts = P.indptr[rows + 1] - P.indptr[rows]
+        first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        pos = np.repeat(P.indptr[rows] - first, counts) + np.arange(np.sum(counts))
+        return pos, np.repeat(np.arange(len(rows)), counts)
+
+    def expected_values(self, V, active=None):
+        """ Expectations p_a(i)^T V[b] of the active instances, with one batched
+            product per chunk of instances
+            - V: value vectors, size B x nb_s
+            - active: boolean mask of the instances, all of them by default
+            - return an array of size (number of active instances) x nb_s x nb_a """
+        active = np.ones(self.nb_b, dtype=bool) if active is None else active
+        out = np.empty((np.sum(active), self.nb_s, self.nb_a))
+        nb_rows = self.nb_s * self.nb_a
+        done = 0
+        for sel, inst in self._chunks(active):
+            if self.is_sparse:
+                pos, rows = self._sparse_rows(sel, inst)
+                cols = self.transition.indices[pos] + (rows // nb_rows) * self.nb_s
+                weights = self.transition.probs[pos] * V[sel].reshape(-1)[cols]
+                res = np.bincount(rows, weights=weights, minlength=len(inst) * nb_rows)
+            else:
+                res = np.matmul(self.transition[sel].reshape(len(inst), nb_rows, self.nb_s),
+                                V[sel][:, :, None])
+            out[done:done + len(inst)] = res.reshape(len(inst), self.nb_s, self.nb_a)
+            done += len(inst)
+        return out
+
+def _random_successors(nb_rows, nb_s, nb_succ):
+    """ nb_succ distinct next states drawn uniformly for each of the nb_rows pairs """
+    assert(nb_succ <= nb_s)
+    if 2 * nb_succ > nb_s:
+        indices = np.argsort(np.random.random((nb_rows, nb_s)), axis=1)[:, :nb_succ]
+        return np.sort(indices, axis=1)
+
+    indices = np.sort(np.random.randint(0, nb_s, (nb_rows, nb_succ)), axis=1)
+    redraw = np.any(np.diff(indices, axis=1) == 0, axis=1)
+    while np.any(redraw):
+        indices[redraw] = np.sort(np.random.randint(0, nb_s, (np.sum(redraw), nb_succ)), axis=1)
+        redraw = np.any(np.diff(indices, axis=1) == 0, axis=1)
+    return indices
+
+
+def create_random_DMDP(nb_a, nb_s, reward_func, gamma=0.95, nb_succ=None):
+    """ Random DMDP with rewards R[s, a] = reward_func(s, a)
+        - nb_succ: if given, each (s, a) only leads to nb_succ random next
+          states and the transitions are stored sparsely
+        - see generators for vectorized, seeded generators and larger families """
 
     R = np.zeros((nb_s, nb_a))
     for s in range(nb_s):
         R[s, :] = np.array([reward_func(s, a) for a in range(nb_a)])
 
+    if nb_succ is not None:
+        indices = _random_successors(nb_s * nb_a, nb_s, nb_succ)
+        probs = np.random.random((nb_s * nb_a, nb_succ))
+        probs /= np.sum(probs, axis=1, keepdims=True)
+        indptr = np.arange(nb_s * nb_a + 1, dtype=np.int64) * nb_succ
+        P = Sparse_transition(nb_s, nb_a, indptr, indices.ravel(), probs.ravel())
+        return DMDP(nb_a, nb_s, R, P, gamma)
+
     P = np.random.random((nb_s, nb_a, nb_s))
-    for a in range(nb_a):
-        for s in range(nb_s):
-            P[s, a, :] /= np.sum(P[s, a, :])
+    P /= np.sum(P, axis=2, keepdims=True)
 
     return DMDP(nb_a, nb_s, R, P, gamma)
@@ -0,0 +1,305 @@
+import numpy as np
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+from Approximate_DMDP.DMDP_class import PRECISIONS
+from Approximate_DMDP.generators import dense_DMDP, sparse_DMDP, banded_DMDP, block_DMDP
+from Approximate_DMDP.value_iteration import run_value_iteration, run_prioritized_value_iteration
+from Approximate_DMDP.high_precision_randomized_VI import high_precision_randomized_VI
+from Approximate_DMDP.sublinear_radomizedVI import sublinear_time_randomized_VI
+from Approximate_DMDP.monotonic_randomized_VI import sublinear_random_mon_VI
+from Approximate_DMDP.randomized_primal_dual import Randomized_Primal_Dual
+from Approximate_DMDP.linear_programming import LP_solving_DMDP
+from Approximate_DMDP.policy_iteration import run_policy_iteration, policy_evaluation
+
+
+FAMILIES = ['dense', 'sparse', 'banded', 'block']
+NB_SUCC = 8  # Number of successors of each pair in the sparse and block families
+BLOCK_SIZE = 32  # Number of states of a block in the block family
+RPD_STEPS = 20  # Steps of the primal-dual method per pair (state, action)
+TOLERANCE = 0.2  # Relative increase of a measure reported as a regression
+
+
+def make_DMDP(family, nb_s, nb_a, gamma, seed, nb_succ=NB_SUCC):
+    """ DMDP of a family (see generators), with rewards in [0, 1], fully determined by seed
+        - 'dense': random dense transitions
+        - 'sparse': nb_succ random successors per pair
+        - 'banded': states on a ring, action a moves by a - nb_a//2 up to
+          one state of noise on each side
+        - 'block': blocks of BLOCK_SIZE states, nb_succ successors in the block
+          of each pair and one outside """
+    if family == 'dense':
+        return dense_DMDP(nb_s, nb_a, gamma, rng=seed)
+    if family == 'sparse':
+        return sparse_DMDP(nb_s, nb_a, min(nb_succ, nb_s), gamma, rng=seed)
+    if family == 'banded':
+        return banded_DMDP(nb_s, nb_a, 1, gamma, rng=seed)
+    if family == 'block':
+        nb_blocks = max(2, nb_s // BLOCK_SIZE)
+        return block_DMDP(nb_s, nb_a, nb_blocks, min(nb_succ, nb_s // nb_blocks), gamma=gamma, rng=seed)
+    raise ValueError("Unknown family {}, should be in {}".format(family, FAMILIES))
+
+
+def _run_value_iteration(mdp, eps, delta):
+    pi, V = run_value_iteration(mdp, eps)
+    return V, pi
+
+
+def _run_prioritized(mdp, eps, delta):
+    pi, V = run_prioritized_value_iteration(mdp, eps)
+    return V, pi
+
+
+def _run_high_precision(mdp, eps, delta):
+    v, pi, _ = high_precision_randomized_VI(mdp, eps, delta)
+    return v, pi
+
+
+def _run_sublinear(mdp, eps, delta):
+    v, pi, _ = sublinear_time_randomized_VI(mdp, eps, delta)
+    return v, pi
+
+
+def _run_monotonic(mdp, eps, delta):
+    v, pi, _ = sublinear_random_mon_VI(mdp, eps, delta)
+    return v, pi
+
+
+def _run_primal_dual(mdp, eps, delta):
+    """ The primal-dual method only returns a policy: its value is computed exactly """
+    rpd = Randomized_Primal_Dual.from_DMDP(mdp)
+    T = RPD_STEPS * mdp.nb_s * mdp.nb_a
+    average_policy = rpd.run(T)
+    mdp.nb_samples += T  # one next state drawn per step, from its own tables
+    pi = np.argmax(average_policy, axis=1).reshape(mdp.nb_s, 1)
+    return policy_evaluation(mdp, pi), pi
+
+
+def _run_LP(mdp, eps, delta):
+    v, pi = LP_solving_DMDP(mdp)
+    return v, pi
+
+
+SOLVERS = {'value_iteration': _run_value_iteration,
+           'prioritized': _run_prioritized,
+           'high_precision': _run_high_precision,
+           'sublinear': _run_sublinear,
+           'monotonic': _run_monotonic,
+           'primal_dual': _run_primal_dual,
+           'LP': _run_LP}
+
+
+def _peak_rss():
+    """ Peak resident memory of the current process in MB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _measure(solver, mdp, eps, delta, seed, v_star, conn):
+    """ Run a solver in a child process and send its measures to conn """
+    try:
+        rss_start = _peak_rss()
+        np.random.seed(seed)
+        mdp.nb_samples = 0
+        start_time = time.perf_counter()
+        v, pi = SOLVERS[solver](mdp, eps, delta)
+        duration = time.perf_counter() - start_time
+        v = np.asarray(v, dtype=float).reshape(-1)
+        conn.send({'status': 'ok', 'time': duration,
+                   'peak_rss_mb': _peak_rss(), 'rss_start_mb': rss_start,
+                   'samples': int(mdp.nb_samples),
+                   'error': float(np.max(np.abs(v - v_star)))})
+    except Exception as e:
+        conn.send({'status': 'failed', 'message': '{}: {}'.format(type(e).__name__, e)})
+    conn.close()
+
+
+def run_solver(solver, mdp, eps, delta, seed, v_star, timeout=None):
+    """ Measures of one run of a solver, in a forked process so that the peak
+        memory is its own and a crash or a timeout does not stop the benchmark
+        - v_star: optimal value function of mdp, of size nb_s
+        - return a dict with 'status' ('ok', 'failed' or 'timeout') and, when ok,
+          'time' (s), 'peak_rss_mb', 'rss_start_mb' (memory of the process when
+          the solver starts), 'samples' (next states drawn) and 'error' = |V - V*|_inf
+          (for the primal-dual method, V is the value of its policy) """
+    ctx = multiprocessing.get_context('fork')
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_measure, args=(solver, mdp, eps, delta, seed, v_star, sender))
+    process.start()
+    sender.close()
+
+    if receiver.poll(timeout):
+        try:
+            res = receiver.recv()
+        except EOFError:
+            res = {'status': 'failed', 'message': 'exit code {}'.format(process.exitcode)}
+    else:
+        process.terminate()
+        res = {'status': 'timeout'}
+    process.join()
+    receiver.close()
+    return res
+
+
+def run_benchmark(families=FAMILIES, sizes=(50,), actions=(2,), gammas=(0.8,), eps_values=(0.1,),
+                  delta=0.1, solvers=None, seed=0, timeout=None, verbose=True, precisions=('double',)):
+    """ Run every solver on every configuration (family, nb_s, nb_a, gamma, eps, precision)
+        - the DMDP of a configuration only depends on (family, nb_s, nb_a, gamma, seed),
+          and each solver starts from the same random state
+        - V* is computed by policy iteration, in double precision
+        - precisions: storage types of the DMDP (see PRECISIONS); 'storage_mb' is
+          the size of its transitions, and the runs in a reduced precision report
+          their 'accuracy_cost', the increase of the error over the same run in
+          double precision (when it is ok)
+        - return a dict {'meta': ..., 'results': [one dict per run]} """
+    solvers = list(SOLVERS) if solvers is None else solvers
+    for solver in solvers:
+        if solver not in SOLVERS:
+            raise ValueError("Unknown solver {}, should be in {}".format(solver, list(SOLVERS)))
+    for precision in precisions:
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision {}, should be in {}".format(precision, list(PRECISIONS)))
+
+    results = []
+    for family, nb_s, nb_a, gamma in itertools.product(families, sizes, actions, gammas):
+        mdp = make_DMDP(family, nb_s, nb_a, gamma, seed)
+        _, v_star = run_policy_iteration(mdp)
+        v_star = v_star.reshape(-1)
+
+        baseline = {}
+        for precision in sorted(precisions, key=lambda p: p != 'double'):
+            mdp_p = mdp if precision == 'double' else mdp.astype(precision)
+            for eps, solver in itertools.product(eps_values, solvers):
+                res = {'family': family, 'nb_s': nb_s, 'nb_a': nb_a, 'gamma': gamma,
+                       'eps': eps, 'delta': delta, 'solver': solver, 'seed': seed,
+                       'precision': precision, 'storage_mb': mdp_p.storage_bytes() / 2**20}
+                res.update(run_solver(solver, mdp_p, eps, delta, seed, v_star, timeout))
+                if res['status'] == 'ok' and precision == 'double':
+                    baseline[eps, solver] = res['error']
+                elif res['status'] == 'ok' and (eps, solver) in baseline:
+                    res['accuracy_cost'] = res['error'] - baseline[eps, solver]
+                results.append(res)
+                if verbose:
+                    print(format_result(res))
+
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count()}
+    return {'meta': meta, 'results': results}
+
+
+def _config(res):
+    config = "{family} S={nb_s} A={nb_a} gamma={gamma} eps={eps} {solver}".format(**res)
+    precision = res.get('precision', 'double')
+    return config if precision == 'double' else "{} ({})".format(config, precision)
+
+
+def format_result(res):
+    config = _config(res)
+    if res['status'] != 'ok':
+        return "{}: {} {}".format(config, res['status'], res.get('message', ''))
+    line = "{}: {:.3f}s, {:.0f}MB, {} samples, error {:.2e}".format(
+        config, res['time'], res['peak_rss_mb'], res['samples'], res['error'])
+    if 'accuracy_cost' in res:
+        line += " ({:+.2e} vs double, transitions {:.2f}MB)".format(res['accuracy_cost'], res['storage_mb'])
+    return line
+
+
+def save_results(benchmark, name):
+    with open(name, 'w') as f:
+        json.dump(benchmark, f, indent=1)
+
+
+def load_results(name):
+    with open(name) as f:
+        return json.load(f)
+
+
+def _key(res):
+    return tuple(res[k] for k in ['family', 'nb_s', 'nb_a', 'gamma', 'eps', 'delta', 'solver']) \
+        + (res.get('precision', 'double'),)
+
+
+def compare_results(old, new, tolerance=TOLERANCE, min_time=0.05):
+    """ Regressions of the benchmark new with respect to old, on their common runs:
+        - a run that was ok and no longer is
+        - time or peak memory increased by more than a factor 1 + tolerance (times
+          below min_time seconds are too noisy to be compared)
+        - more samples drawn, or an error above max(eps, old error)
+        - return a list of (configuration, description) """
+    old_results = {_key(res): res for res in old['results']}
+    regressions = []
+
+    for res in new['results']:
+        key = _key(res)
+        if key not in old_results:
+            continue
+        ref = old_results[key]
+        config = _config(res)
+
+        if res['status'] != 'ok':
+            if ref['status'] == 'ok':
+                regressions.append((config, "status {}".format(res['status'])))
+            continue
+        if ref['status'] != 'ok':
+            continue
+
+        if max(res['time'], ref['time']) > min_time and res['time'] > (1 + tolerance) * ref['time']:
+            regressions.append((config, "time {:.3f}s -> {:.3f}s".format(ref['time'], res['time'])))
+        if res['peak_rss_mb'] - res['rss_start_mb'] > \
+           (1 + tolerance) * max(ref['peak_rss_mb'] - ref['rss_start_mb'], 1):
+            regressions.append((config, "memory {:.0f}MB -> {:.0f}MB".format(
+                ref['peak_rss_mb'] - ref['rss_start_mb'], res['peak_rss_mb'] - res['rss_start_mb'])))
+        if res['samples'] > (1 + tolerance) * ref['samples']:
+            regressions.append((config, "samples {} -> {}".format(ref['samples'], res['samples'])))
+        if res['error'] > max(res['eps'], ref['error']):
+            regressions.append((config, "error {:.2e} -> {:.2e}".format(ref['error'], res['error'])))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the DMDP solvers")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run the benchmark and save the results")
+    run.add_argument('--families', nargs='+', default=FAMILIES, choices=FAMILIES)
+    run.add_argument('--sizes', nargs='+', type=int, default=[50])
+    run.add_argument('--actions', nargs='+', type=int, default=[2])
+    run.add_argument('--gammas', nargs='+', type=float, default=[0.8])
+    run.add_argument('--eps', nargs='+', type=float, default=[0.1])
+    run.add_argument('--delta', type=float, default=0.1)
+    run.add_argument('--solvers', nargs='+', default=list(SOLVERS), choices=list(SOLVERS))
+    run.add_argument('--precisions', nargs='+', default=['double'], choices=list(PRECISIONS))
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--timeout', type=float, default=None, help="seconds per run")
+    run.add_argument('--out', default='benchmark.json')
+
+    compare = commands.add_parser('compare', help="flag the regressions between two results files")
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--tolerance', type=float, default=TOLERANCE)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        benchmark = run_benchmark(args.families, args.sizes, args.actions, args.gammas, args.eps,
+                                  args.delta, args.solvers, args.seed, args.timeout,
+                                  precisions=args.precisions)
+        save_results(benchmark, args.out)
+        return 0
+
+    regressions = compare_results(load_results(args.old), load_results(args.new), args.tolerance)
+    for config, description in regressions:
+        print("REGRESSION {}: {}".format(config, description))
+    print("{} regression(s)".format(len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
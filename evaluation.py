@@ -0,0 +1,116 @@
+import numpy as np
+from scipy.sparse.linalg import LinearOperator, bicgstab, gmres
+
+
+BLOCK_SIZE = 2**14  # Number of states whose Q-values are computed together
+
+
+def policy_weights(mdp, pi):
+    """ Probabilities pi(i, a) of size nb_s x nb_a of a policy given as
+        - the actions of a deterministic policy, of size nb_s or nb_s x 1 (float
+          indices, as returned by the value iteration solvers)
+        - a stochastic policy of size nb_s x nb_a (as Randomized_Primal_Dual.run),
+          whose rows are normalized """
+    pi = np.asarray(pi)
+    if pi.shape == (mdp.nb_s, mdp.nb_a) and mdp.nb_a > 1:
+        return pi / np.sum(pi, axis=1, keepdims=True)
+    if pi.size != mdp.nb_s:
+        raise ValueError("A policy should have size {} or {} x {}, not {}".format(
+            mdp.nb_s, mdp.nb_s, mdp.nb_a, pi.shape))
+    weights = np.zeros((mdp.nb_s, mdp.nb_a))
+    weights[np.arange(mdp.nb_s), np.ravel(pi).astype(int)] = 1
+    return weights
+
+
+def _q_values(mdp, v, start, stop, pool=None):
+    """ Q(i, a) = R(i, a) + gamma*p_a(i)^T v for start <= i < stop """
+    if pool is not None:
+        return mdp.rewards + mdp.gamma * pool.expected_values(v)
+    return mdp.rewards[start:stop] + mdp.gamma * mdp.expected_values(v, start, stop)
+
+
+def _policy_step(mdp, weights, v, pool=None):
+    """ T^pi v = r_pi + gamma*P_pi v, matrix-free """
+    if pool is not None:
+        return np.sum(weights * _q_values(mdp, v, 0, mdp.nb_s, pool), axis=1)
+    out = np.empty(mdp.nb_s)
+    for start in range(0, mdp.nb_s, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, mdp.nb_s)
+        out[start:stop] = np.sum(weights[start:stop] * _q_values(mdp, v, start, stop), axis=1)
+    return out
+
+
+def evaluate_policy(mdp, pi, method='bicgstab', tol=1e-10, v_init=None, iter_max=1000, pool=None):
+    """ Value V^pi of a policy, solving (I - gamma*P_pi) v = r_pi without building P_pi:
+        each product by P_pi is one pass of mdp.expected_values over the
+        transitions (sparse, dense or memory-mapped), so the memory stays linear
+        in nb_s and each iteration in the number of transitions
+        - pi: deterministic or stochastic policy (see policy_weights)
+        - method: 'bicgstab' or 'gmres' (Krylov, relative tolerance tol), or
+          'iteration' (v <- T^pi v until |v - T^pi v|_inf <= tol*(1 - gamma))
+        - v_init: initial guess (0 by default), e.g. the value returned by the solver
+        - pool: Sweep_pool to shard the passes over the transitions
+        - return v of size nb_s x 1 """
+    weights = policy_weights(mdp, pi)
+    r_pi = np.sum(weights * mdp.rewards, axis=1)
+    v = np.zeros(mdp.nb_s) if v_init is None else np.array(v_init, dtype=float).reshape(mdp.nb_s)
+
+    if method == 'iteration':
+        for k in range(iter_max):
+            v_new = _policy_step(mdp, weights, v, pool)
+            residual = np.max(np.abs(v_new - v))
+            v = v_new
+            if residual <= tol * (1 - mdp.gamma):
+                break
+        else:
+            print('Policy evaluation did not converge in {} iterations'.format(iter_max))
+        return v.reshape(mdp.nb_s, 1)
+
+    if method not in ('bicgstab', 'gmres'):
+        raise ValueError("Unknown method '{}', expected 'bicgstab', 'gmres' or 'iteration'".format(method))
+    # (I - gamma*P_pi) v = v - (T^pi v - r_pi)
+    A = LinearOperator((mdp.nb_s, mdp.nb_s), dtype=float,
+                       matvec=lambda x: x.ravel() - _policy_step(mdp, weights, x.ravel(), pool) + r_pi)
+    solve = bicgstab if method == 'bicgstab' else gmres
+    v, info = solve(A, r_pi, v, rtol=tol, maxiter=iter_max)
+    if info > 0:
+        print('{} did not converge in {} iterations'.format(method, info))
+    return v.reshape(mdp.nb_s, 1)
+
+
+def bellman_residuals(mdp, pi, v, pool=None):
+    """ One sweep over the transitions computing, for a value function v,
+        - b = |T v - v|_inf, the residual of the Bellman optimality operator
+        - rho = |T^pi v - v|_inf, the residual of the evaluation of pi
+        - return b, rho """
+    weights = policy_weights(mdp, pi)
+    v = np.asarray(v, dtype=float).reshape(mdp.nb_s)
+    if pool is not None:
+        Q = _q_values(mdp, v, 0, mdp.nb_s, pool)
+        return np.max(np.abs(np.max(Q, axis=1) - v)), np.max(np.abs(np.sum(weights * Q, axis=1) - v))
+
+    b, rho = 0., 0.
+    for start in range(0, mdp.nb_s, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, mdp.nb_s)
+        Q = _q_values(mdp, v, start, stop)
+        b = max(b, np.max(np.abs(np.max(Q, axis=1) - v[start:stop])))
+        rho = max(rho, np.max(np.abs(np.sum(weights[start:stop] * Q, axis=1) - v[start:stop])))
+    return b, rho
+
+
+def certify_policy(mdp, pi, v=None, pool=None, **kwargs):
+    """ Certified bound on |V^pi - V*|_inf for a policy returned by any solver
+        - v: approximation of V^pi, computed by evaluate_policy (with kwargs) if None
+        - with b and rho the residuals of v (see bellman_residuals),
+          |v - V*| <= b/(1 - gamma) and |v - V^pi| <= rho/(1 - gamma), so
+          |V^pi - V*|_inf <= (b + rho)/(1 - gamma); the certificate costs one
+          sweep over the transitions on top of the evaluation
+        - return v (nb_s x 1) and a dict with 'residual' (b), 'evaluation_residual'
+          (rho), 'bound' on |V^pi - V*|_inf and 'value_error' = rho/(1 - gamma),
+          the bound on |v - V^pi|_inf """
+    if v is None:
+        v = evaluate_policy(mdp, pi, pool=pool, **kwargs)
+    v = np.asarray(v, dtype=float).reshape(mdp.nb_s, 1)
+    b, rho = bellman_residuals(mdp, pi, v, pool)
+    return v, {'residual': b, 'evaluation_residual': rho,
+               'bound': (b + rho) / (1 - mdp.gamma), 'value_error': rho / (1 - mdp.gamma)}
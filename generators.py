@@ -0,0 +1,181 @@
+"""
+Vectorized DMDP generators.
+
+All the generators are seeded by rng (a np.random.Generator or a seed) and
+draw the DMDP by chunks of states, in the same order whether it is built in
+memory or written to the directory path (see mdp_storage): the same rng gives
+the same DMDP both ways, and an on-disk DMDP never needs more than one chunk
+in memory.
+
+reward_func(states, actions) is array-valued: it is called on a column of
+states and a row of actions and returns the rewards of the chunk, of size
+nb_states x nb_a. By default the rewards are uniform in [0, 1].
+"""
+
+import numpy as np
+
+from Approximate_DMDP.DMDP_class import DMDP, Sparse_transition
+from Approximate_DMDP.mdp_storage import create_DMDP_files, open_DMDP, _chunk_states
+
+
+def _distinct(rng, nb_rows, n, k):
+    """ k distinct integers of [0, n) drawn uniformly for each of the nb_rows rows, sorted """
+    assert(k <= n)
+    if 2 * k > n:
+        return np.sort(np.argsort(rng.random((nb_rows, n)), axis=1)[:, :k], axis=1)
+
+    draws = np.sort(rng.integers(0, n, (nb_rows, k)), axis=1)
+    redraw = np.any(np.diff(draws, axis=1) == 0, axis=1)
+    while np.any(redraw):
+        draws[redraw] = np.sort(rng.integers(0, n, (np.sum(redraw), k)), axis=1)
+        redraw = np.any(np.diff(draws, axis=1) == 0, axis=1)
+    return draws
+
+
+def _normalized(probs):
+    return probs / np.sum(probs, axis=-1, keepdims=True)
+
+
+def _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, nb_succ=None, path=None):
+    """ Draw a DMDP by chunks of states
+        - transitions(start, stop): probabilities of the chunk, of size
+          (stop - start) x nb_a x nb_s if nb_succ is None (dense), else
+          (next states, probabilities) of size (stop - start)*nb_a x nb_succ
+        - path: directory where the DMDP is written, in memory if None """
+    row_size = nb_s if nb_succ is None else 2 * nb_succ
+    step = _chunk_states(nb_s, 8 * nb_a * row_size)
+
+    if path is None:
+        R = np.zeros((nb_s, nb_a))
+        if nb_succ is None:
+            files = {'rewards': R, 'transition': np.zeros((nb_s, nb_a, nb_s))}
+        else:
+            files = {'rewards': R, 'indices': np.zeros(nb_s * nb_a * nb_succ, dtype=np.int64),
+                     'probs': np.zeros(nb_s * nb_a * nb_succ)}
+    else:
+        # M is computed from the rewards when the DMDP is opened
+        files = create_DMDP_files(path, nb_a, nb_s, gamma, None,
+                                  None if nb_succ is None else nb_s * nb_a * nb_succ)
+
+    for start in range(0, nb_s, step):
+        stop = min(start + step, nb_s)
+        if reward_func is None:
+            files['rewards'][start:stop] = rng.random((stop - start, nb_a))
+        else:
+            files['rewards'][start:stop] = reward_func(np.arange(start, stop)[:, None],
+                                                       np.arange(nb_a)[None, :])
+        if nb_succ is None:
+            files['transition'][start:stop] = transitions(start, stop)
+        else:
+            indices, probs = transitions(start, stop)
+            first, last = start * nb_a * nb_succ, stop * nb_a * nb_succ
+            files['indices'][first:last] = indices.ravel()
+            files['probs'][first:last] = probs.ravel()
+
+    if nb_succ is not None:
+        indptr = np.arange(nb_s * nb_a + 1, dtype=np.int64) * nb_succ
+        if path is not None:
+            files['indptr'][:] = indptr
+
+    if path is not None:
+        for array in files.values():
+            array.flush()
+        return open_DMDP(path)
+
+    if nb_succ is None:
+        return DMDP(nb_a, nb_s, files['rewards'], files['transition'], gamma)
+    P = Sparse_transition(nb_s, nb_a, indptr, files['indices'], files['probs'])
+    return DMDP(nb_a, nb_s, files['rewards'], P, gamma)
+
+
+def dense_DMDP(nb_s, nb_a, gamma=0.95, reward_func=None, rng=None, path=None):
+    """ DMDP whose distributions p_a(s) are uniform random vectors normalized to 1 """
+    rng = np.random.default_rng(rng)
+
+    def transitions(start, stop):
+        return _normalized(rng.random((stop - start, nb_a, nb_s)))
+
+    return _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, path=path)
+
+
+def sparse_DMDP(nb_s, nb_a, nb_succ, gamma=0.95, reward_func=None, rng=None, path=None):
+    """ DMDP where each (s, a) leads to nb_succ distinct next states drawn
+        uniformly, with random probabilities """
+    rng = np.random.default_rng(rng)
+
+    def transitions(start, stop):
+        nb_rows = (stop - start) * nb_a
+        return _distinct(rng, nb_rows, nb_s, nb_succ), _normalized(rng.random((nb_rows, nb_succ)))
+
+    return _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, nb_succ, path)
+
+
+def banded_DMDP(nb_s, nb_a, bandwidth=1, gamma=0.95, reward_func=None, rng=None, path=None):
+    """ DMDP on a ring of states: action a moves from s towards s + a - nb_a//2,
+        and lands on one of the 2*bandwidth + 1 states around it with random
+        probabilities. Seen as a matrix, P is banded (up to the wrap around). """
+    assert(2 * bandwidth + 1 <= nb_s)
+    rng = np.random.default_rng(rng)
+    nb_succ = 2 * bandwidth + 1
+    shift = np.arange(nb_a) - nb_a // 2
+    band = np.arange(-bandwidth, bandwidth + 1)
+
+    def transitions(start, stop):
+        target = np.arange(start, stop)[:, None] + shift[None, :]
+        indices = np.sort((target[:, :, None] + band) % nb_s, axis=2)
+        return indices.reshape(-1, nb_succ), _normalized(rng.random(((stop - start) * nb_a, nb_succ)))
+
+    return _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, nb_succ, path)
+
+
+GRID_MOVES = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1]])  # stay, up, down, left, right
+
+
+def grid_DMDP(height, width, slip=0.2, gamma=0.95, reward_func=None, rng=None, path=None):
+    """ Grid world on a torus of height x width cells, state s = row*width + column
+        - 5 actions (GRID_MOVES): the intended move is made with probability
+          1 - slip, otherwise one of the 5 moves is made uniformly """
+    assert(height >= 3 and width >= 3)
+    rng = np.random.default_rng(rng)
+    nb_s, nb_a = height * width, len(GRID_MOVES)
+    probs = np.full((nb_a, nb_a), slip / nb_a) + (1 - slip) * np.eye(nb_a)
+
+    def transitions(start, stop):
+        states = np.arange(start, stop)
+        rows = (states // width)[:, None] + GRID_MOVES[:, 0]
+        cols = (states % width)[:, None] + GRID_MOVES[:, 1]
+        moved = (rows % height) * width + cols % width  # next state of each move
+        indices = np.repeat(moved, nb_a, axis=0)
+        p = np.tile(probs, (stop - start, 1))
+        order = np.argsort(indices, axis=1)
+        return np.take_along_axis(indices, order, 1), np.take_along_axis(p, order, 1)
+
+    return _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, nb_a, path)
+
+
+def block_DMDP(nb_s, nb_a, nb_blocks, nb_succ, p_out=0.05, gamma=0.95, reward_func=None,
+               rng=None, path=None):
+    """ DMDP whose states are split into nb_blocks contiguous blocks of nearly
+        communicating states: each (s, a) leads to nb_succ distinct states of the
+        block of s with total probability 1 - p_out, and to one state outside it
+        with probability p_out """
+    rng = np.random.default_rng(rng)
+    bounds = np.linspace(0, nb_s, nb_blocks + 1).astype(np.int64)
+    assert(nb_blocks >= 2 and nb_succ <= np.min(np.diff(bounds)))
+
+    def transitions(start, stop):
+        block = np.searchsorted(bounds, np.arange(start, stop), side='right') - 1
+        block = np.repeat(block, nb_a)
+        first, size = bounds[block], bounds[block + 1] - bounds[block]
+        indices = np.empty((len(block), nb_succ + 1), dtype=np.int64)
+        for b in np.unique(block):
+            rows = block == b
+            indices[rows, :nb_succ] = first[rows, None] + _distinct(rng, np.sum(rows), size[rows][0], nb_succ)
+        outside = rng.integers(0, nb_s - size)
+        indices[:, nb_succ] = np.where(outside < first, outside, outside + size)
+        probs = (1 - p_out) * _normalized(rng.random((len(block), nb_succ)))
+        probs = np.concatenate([probs, np.full((len(block), 1), p_out)], axis=1)
+        order = np.argsort(indices, axis=1)
+        return np.take_along_axis(indices, order, 1), np.take_along_axis(probs, order, 1)
+
+    return _generate(nb_s, nb_a, gamma, rng, reward_func, transitions, nb_succ + 1, path)
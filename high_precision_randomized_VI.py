@@ -1,28 +1,40 @@
 import numpy as np
+import contextlib
 import math
+import time
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
-from Approximate_DMDP.randomized_value_iteration import randomizedVI
+from Approximate_DMDP.randomized_value_iteration import randomizedVI, _adaptive_phase, \
+    _adaptive_report, _bernstein_report, _warm_start, apx_trans_all, certified_bound
+from Approximate_DMDP.instrumentation import sample_count, hoeffding_count
 
 
-def high_precision_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0):
+def high_precision_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0, pool=None,
+                                 recorder=None, adaptive=False, v_init=None, err_init=None,
+                                 bernstein=False):
     """ High Precision Randomized Value Iteration
         Gives an eps-approximate value function with probability 1 - delta
         - analyze: to plot the convergence of the value function
+        - pool: Sweep_pool to shard the states across processes
+        - recorder: Recorder receiving the timings, samples drawn and residuals
+          of every iteration (see instrumentation)
+        - adaptive: stop the inner loops and skip the outer iterations on a
+          certified bound (see _adaptive_phase), reported in analysis['adaptive']
+        - v_init, err_init: warm start (see _warm_start)
+        - bernstein: adapt the number of samples of each pair (i, a), reported
+          in analysis['bernstein'] (see _bernstein_report)
     """
-    K = math.log(mdp.M / (eps * (1 - mdp.gamma)), 2)
-    K = int(K) + 1
+    v0, eps_prev = _warm_start(mdp, v0_value, v_init, err_init)
+
+    K = math.log(eps_prev / eps, 2)
+    K = max(int(K) + 1, 1)
     L = 1. / (1 - mdp.gamma) * math.log(4. / (1 - mdp.gamma))
     L = int(L) + 1
-
-    v0 = np.zeros((mdp.nb_s, 1)) + v0_value
     v_prev = v0
-    eps_prev = mdp.M / (1 - mdp.gamma)
 
     analysis = {}  # To keep convergence informations
     if analyze: # Keep history of convergence
-        print("{} iterations and {} iterations for randomized_VI".format(K, L))
         # Information about the problem
         analysis['eps'] = eps
         analysis['delta'] = delta
@@ -38,11 +50,33 @@ def high_precision_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0):
         analysis['pi'] = []
         analysis['m_hist'] = {}
 
+    if recorder is not None:
+        recorder.record('setup', K=K, L=L, eps=eps, delta=delta, M=mdp.M,
+                        nb_s=mdp.nb_s, nb_a=mdp.nb_a, gamma=mdp.gamma)
+
+    if adaptive:
+        analysis['adaptive'] = {'outer_iterations': 0, 'inner_iterations': 0,
+                                'skipped_outer': 0, 'samples': 0}
+    samples_start, hoeffding_start = sample_count(mdp, pool), hoeffding_count(mdp, pool)
+    skip = 0
+
     for k in tqdm(range(K)):
+        start_time_k = time.time()
         eps_k = eps_prev * 0.5
+        if skip > 0:  # v_prev is already certified eps_k-approximate
+            skip -= 1
+            eps_prev = eps_k
+            continue
+
         eps_func = (1 - mdp.gamma) * eps_k / (4 * mdp.gamma)
-        v_k, pi_k, m_hist = randomizedVI(mdp, v_prev, L, eps_func, 
-                                 delta / K, analyze)
+        early_stop = {'target': eps_k, 'err': eps_func} if adaptive else None
+        samples_k = sample_count(mdp, pool)
+        with (recorder.scope(k=k) if recorder else contextlib.nullcontext()):
+            v_k, pi_k, m_hist = randomizedVI(mdp, v_prev, L, eps_func, delta / K, analyze, pool,
+                                             recorder, early_stop, bernstein)
+        if recorder is not None:
+            recorder.record('outer', k=k, duration=time.time() - start_time_k, eps_k=eps_k,
+                            samples=sample_count(mdp, pool) - samples_k)
 
         if analyze:
             analysis['V_hist'].append(v_k)
@@ -52,4 +86,83 @@ def high_precision_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0):
         eps_prev = eps_k
         v_prev = v_k
 
+        if adaptive:
+            skip, done = _adaptive_phase(analysis['adaptive'], early_stop, eps_k, eps,
+                                         sample_count(mdp, pool) - samples_k)
+            if done:
+                break
+
+    if adaptive:
+        _adaptive_report(analysis['adaptive'], K, L)
+
+    if bernstein:
+        analysis['bernstein'] = _bernstein_report(mdp, pool, samples_start, hoeffding_start)
+
     return v_k, pi_k, analysis
+
+
+def batched_high_precision_randomized_VI(bmdp, eps, delta, v0_value=0, adaptive=False,
+                                         bernstein=False):
+    """ High Precision Randomized Value Iteration of the B instances of a
+        Batched_DMDP together, each eps-approximate with probability 1 - delta
+        - instance b runs its own K_b outer and L_b inner iterations (they depend
+          on gamma_b and M_b) and stops consuming work once they are done; the
+          exact products x = p^T v0 and the maxima over the actions are batched
+          over the active instances, the samples are drawn instance by instance
+          (their number m depends on the instance)
+        - adaptive: stop the inner loop of an instance as soon as its certified
+          bound reaches eps_k, and the instance once it reaches eps (see
+          _adaptive_phase, without the skipping of outer iterations)
+        - bernstein: see apx_trans_block
+        - return v, pi of size B x nb_s x 1 and analysis, with the numbers of outer
+          and inner iterations of each instance """
+    B, n, nb_a, gamma = bmdp.nb_b, bmdp.nb_s, bmdp.nb_a, bmdp.gamma
+    eps_prev = bmdp.M / (1 - gamma)
+    K = np.maximum(np.log2(eps_prev / eps), 0).astype(int) + 1
+    L = (1. / (1 - gamma) * np.log(4. / (1 - gamma))).astype(int) + 1
+    v_prev = np.zeros((B, n)) + v0_value
+    pi = np.zeros((B, n), dtype=bmdp.dtypes['policy'])
+    analysis = {'K': K, 'L': L, 'outer_iterations': np.zeros(B, dtype=int),
+                'inner_iterations': np.zeros(B, dtype=int)}
+    done = np.zeros(B, dtype=bool)
+
+    for k in tqdm(range(np.max(K))):
+        active = (k < K) & ~done
+        if not np.any(active):
+            break
+        act = np.flatnonzero(active)
+        eps_k = eps_prev[act] * 0.5
+        eps_func = (1 - gamma[act]) * eps_k / (4 * gamma[act])
+        g = gamma[act, None, None]
+        v0 = v_prev[act]
+        x = bmdp.expected_values(v_prev, active)
+        u = v0.copy()
+        inner = np.ones(len(act), dtype=bool)
+
+        for l in range(np.max(L[act])):
+            inner &= l < L[act]
+            if not np.any(inner):
+                break
+            rows = np.flatnonzero(inner)
+            trans = np.empty((len(rows), n, nb_a))
+            for j, r in enumerate(rows):
+                b = act[r]
+                w = (u[r] - v0[r])[:, None]
+                trans[j] = apx_trans_all(bmdp.instance(b), w, np.max(np.abs(w)), eps_func[r],
+                                         delta / (K[b] * L[b] * n * nb_a), bernstein=bernstein)
+            Q = bmdp.rewards[act[rows]] + g[rows] * (x[rows] + trans)
+            v_l = np.max(Q, axis=2)
+            residual = np.max(np.abs(v_l - u[rows]), axis=1)
+            u[rows], pi[act[rows]] = v_l, np.argmax(Q, axis=2)
+            analysis['inner_iterations'][act[rows]] += 1
+
+            if adaptive:
+                bound = certified_bound(gamma[act[rows]], residual, eps_func[rows])
+                inner[rows[bound <= eps_k[rows]]] = False
+                done[act[rows[bound <= eps]]] = True
+
+        v_prev[act] = u
+        eps_prev[act] = eps_k
+        analysis['outer_iterations'][act] += 1
+
+    return v_prev[:, :, None], pi[:, :, None], analysis
@@ -0,0 +1,83 @@
+import numpy as np
+
+from Approximate_DMDP.value_iteration import prioritized_backups
+
+
+def apply_changes(mdp, rewards=None, transitions=None):
+    """ Modify a DMDP in place
+        - rewards: dict {(s, a): new reward}
+        - transitions: dict {(s, a): (next states, probabilities)}, the new
+          distribution p_a(s)
+        - the cached tables of the changed states are invalidated; a sparse
+          DMDP is rebuilt only if a changed row does not keep its number of
+          successors, otherwise the rows are overwritten in place
+        - return the sorted array of the states whose pairs changed """
+    rewards = rewards or {}
+    transitions = transitions or {}
+
+    for (s, a), r in rewards.items():
+        mdp.rewards[s, a] = r
+    if rewards:
+        mdp.M = max(mdp.M, int(np.max(np.abs(list(rewards.values())))) + 1)
+
+    if transitions and not mdp.is_sparse:
+        for (s, a), (indices, probs) in transitions.items():
+            mdp.transition[s, a, :] = 0
+            mdp.transition[s, a, indices] = probs
+
+    if transitions and mdp.is_sparse:
+        P = mdp.transition
+        rows = {s * mdp.nb_a + a: (np.asarray(indices), np.asarray(probs))
+                for (s, a), (indices, probs) in transitions.items()}
+        counts = np.diff(P.indptr)
+        if all(len(indices) == counts[r] for r, (indices, _) in rows.items()):
+            for r, (indices, probs) in rows.items():
+                P.indices[P.indptr[r]:P.indptr[r + 1]] = indices
+                P.probs[P.indptr[r]:P.indptr[r + 1]] = probs
+        else:
+            changed = np.array(sorted(rows))
+            new_counts = counts.copy()
+            new_counts[changed] = [len(rows[r][0]) for r in changed]
+            indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(new_counts, out=indptr[1:])
+
+            # entries of the unchanged rows are moved by the shift of their row
+            entry_rows = np.repeat(np.arange(len(counts)), counts)
+            keep = ~np.isin(entry_rows, changed)
+            pos = np.arange(P.nnz)[keep] + (indptr[:-1] - P.indptr[:-1])[entry_rows[keep]]
+            indices = np.zeros(indptr[-1], dtype=P.indices.dtype)
+            probs = np.zeros(indptr[-1], dtype=P.probs.dtype)
+            indices[pos], probs[pos] = P.indices[keep], P.probs[keep]
+            for r in changed:
+                indices[indptr[r]:indptr[r + 1]], probs[indptr[r]:indptr[r + 1]] = rows[r]
+            P.indptr, P.indices, P.probs = indptr, indices, probs
+
+    states = np.unique([s for s, _ in list(rewards) + list(transitions)]).astype(np.int64)
+    if transitions:
+        mdp.invalidate(np.unique([s for s, _ in transitions]))
+    return states
+
+
+def incremental_resolve(mdp, V, pi, states, eps, residual_init=0., analyze=False):
+    """ Update a solution (pi, V) of a DMDP after the pairs of states changed
+        (see apply_changes), with prioritized Bellman backups of single states
+        (see prioritized_backups): the changed states are backed up first, then
+        the predecessors whose bound on the residual exceeds eps*(1 - gamma)
+        - residual_init: residual of the previous solution V on the states that
+          did not change, must be below eps*(1 - gamma) (0 for an exact solution)
+        - at the end |T(V) - V|_inf <= eps*(1 - gamma), so |V - V*|_inf <= eps.
+          The work only depends on the states reached by the change.
+        - analyze: also return the number of backups
+        - return pi, V (new arrays of size nb_s x 1) """
+    tol = eps * (1 - mdp.gamma)
+    assert(residual_init < tol)
+    V = np.array(V, dtype=float).reshape(mdp.nb_s, 1)
+    pi = np.array(pi, dtype=mdp.dtypes['policy']).reshape(mdp.nb_s, 1)
+
+    res = np.full(mdp.nb_s, residual_init, dtype=float)
+    res[states] = np.inf
+    nb_backups = prioritized_backups(mdp, V, pi, res, tol, states)
+
+    if analyze:
+        return pi, V, nb_backups
+    return pi, V
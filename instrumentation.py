@@ -0,0 +1,111 @@
+import numpy as np
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def memory_usage():
+    """ Resident memory of the current process in MB (the peak one where the
+        current one is not available) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def sample_count(mdp, pool=None):
+    """ Next states drawn so far from mdp, including the ones drawn by the
+        workers of the Sweep_pool pool """
+    return mdp.nb_samples + (pool.nb_samples if pool is not None else 0)
+
+
+def hoeffding_count(mdp, pool=None):
+    """ Next states the Hoeffding sample sizes of apx_trans asked for so far,
+        to compare with sample_count when the sample sizes are adaptive """
+    return mdp.nb_samples_hoeffding + (pool.nb_samples_hoeffding if pool is not None else 0)
+
+
+class Recorder:
+    """
+    Metrics recorder of a solver run.
+
+    Solvers take recorder=None and only measure anything when a recorder is given,
+    so that a disabled recorder costs nothing. Each measure is a record: a dict
+    with the event name, the time since the creation of the recorder (s), the
+    labels of the enclosing scopes (e.g. the outer iteration k), the memory in use
+    (MB) if track_memory, and the fields given by the solver.
+
+    The events of the randomized solvers are:
+        - 'setup': K, L (or T), eps, delta and the sizes of the DMDP
+        - 'trans': computation of x = p^T v_k, with its duration, the number m
+          of samples per pair and the exact number of next states drawn
+        - 'iteration': one iteration l of the inner loop, with its duration, m,
+          the exact samples drawn and the residual |v_l - v_(l-1)|_inf
+        - 'outer': one iteration k, with its duration, eps_k and the samples drawn
+
+    - callbacks: functions called with each record as soon as it is made
+    """
+
+    def __init__(self, callbacks=(), track_memory=True):
+
+        self.callbacks = list(callbacks)
+        self.track_memory = track_memory
+        self.records = []
+        self.labels = {}
+        self.start_time = time.perf_counter()
+
+    def record(self, event, **fields):
+        rec = {'event': event, 'time': time.perf_counter() - self.start_time}
+        rec.update(self.labels)
+        if self.track_memory:
+            rec['rss_mb'] = memory_usage()
+        rec.update(fields)
+        self.records.append(rec)
+        for callback in self.callbacks:
+            callback(rec)
+        return rec
+
+    @contextmanager
+    def scope(self, **labels):
+        """ Add labels to the records made within the scope """
+        previous = self.labels
+        self.labels = dict(previous, **labels)
+        try:
+            yield self
+        finally:
+            self.labels = previous
+
+    def select(self, event):
+        return [rec for rec in self.records if rec['event'] == event]
+
+    def total(self, event, field):
+        """ Sum of a field over the records of an event """
+        return sum(rec[field] for rec in self.select(event))
+
+    def to_json(self, name):
+        with open(name, 'w') as f:
+            json.dump(self.records, f, indent=1, default=_to_builtin)
+
+    def to_csv(self, name):
+        """ One row per record, with the union of the fields as columns """
+        columns = []
+        for rec in self.records:
+            columns += [c for c in rec if c not in columns]
+        with open(name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+def _to_builtin(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("{} is not JSON serializable".format(type(x).__name__))
@@ -1,6 +1,10 @@
 import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import linprog
 import pulp
 
+from Approximate_DMDP.value_iteration import bellman_backup
+
 def i_a_to_indice(i, a, nb_a):
     """ Transform (i, a) to an unique indice """
     return i*nb_a + a
@@ -12,58 +16,123 @@ def indice_to_i_a(indice, nb_a):
 
 def LP_param_DMDP(mdp):
     """ Find the matrices A, r such as the constraint of the LP is A.v >= r
-        - A = E - gamma*P , size = (nb_s * nb_a) x nb_s
+        - A = E - gamma*P , size = (nb_s * nb_a) x nb_s, sparse (scipy CSR)
               with E[(i, a), j] = 1 iff i == j
               and P transition matrix of the MDP
         - r reward vector of size nb_s*nb_a x 1 """
-    r = np.zeros((mdp.nb_s * mdp.nb_a, 1))
-    A = np.zeros((mdp.nb_s * mdp.nb_a, mdp.nb_s))
-
-    for a in range(mdp.nb_a):
-        for s in range(mdp.nb_s):
-            indice = i_a_to_indice(s, a, mdp.nb_a)
-            r[indice] = mdp.rewards[s, a]
-
-            for j in range(mdp.nb_s):
-                if j == s:
-                    A[indice][j] = 1 - mdp.gamma*mdp.transition[s, a, j]
-                else:
-                    A[indice][j] = - mdp.gamma*mdp.transition[s, a, j]
+    r = np.asarray(mdp.rewards, dtype=float).reshape(mdp.nb_s * mdp.nb_a, 1)
+    E = sp.kron(sp.identity(mdp.nb_s, format='csr'), np.ones((mdp.nb_a, 1)), format='csr')
+    A = (E - mdp.gamma * mdp.transition_matrix()).tocsr()
+
     return A, r
 
-def LP_solving_DMDP(mdp):
-    A, r = LP_param_DMDP(mdp)
+def LP_param_pairs(mdp, states, actions):
+    """ Same as LP_param_DMDP, restricted to the rows of the pairs (states[k], actions[k]) """
+    nb_rows = len(states)
+    r = np.asarray(mdp.rewards[states, actions], dtype=float).reshape(nb_rows, 1)
+    E = sp.csr_matrix((np.ones(nb_rows), (np.arange(nb_rows), states)), shape=(nb_rows, mdp.nb_s))
+    A = (E - mdp.gamma * mdp.transition_matrix(states, actions)).tocsr()
+
+    return A, r
+
+def solve_LP(A, r, nb_s, solver='highs-ipm'):
+    """ Minimize sum(v) such as A.v >= r and v >= 0
+        - solver: a HiGHS method of scipy.optimize.linprog ('highs-ipm', which
+          scales best on these LPs, 'highs-ds' or 'highs') or 'pulp'
+        - return v, or None if no optimal solution is found """
+    if solver.startswith('highs'):
+        res = linprog(np.ones(nb_s), A_ub=-A, b_ub=-r[:, 0], bounds=(0, None), method=solver)
+        if res.status != 0:
+            print("No optimal solution found, status =", res.message)
+            return None
+        return res.x
+
+    if solver != 'pulp':
+        raise ValueError("Unknown solver '{}', expected a HiGHS method or 'pulp'".format(solver))
 
     # Instantiate our problem class
     model = pulp.LpProblem("LP minimizing problem", pulp.LpMinimize)
 
     # Variable
     v = pulp.LpVariable.dicts("Value Function",
-                              (i for i in range(mdp.nb_s)),
+                              (i for i in range(nb_s)),
                               lowBound=0,
                               cat='Continuous')
 
     # Objective function
-    model += pulp.lpSum([v[i] for i in range(mdp.nb_s)])
+    model += pulp.lpSum([v[i] for i in range(nb_s)])
 
-    # Constraints
-    for j in range(mdp.nb_s * mdp.nb_a):
-        model += pulp.lpSum([A[j, k] * v[k] for k in range(mdp.nb_s)]) >= r[j, 0]
+    # Constraints, only over the nonzero coefficients of each row
+    for j in range(A.shape[0]):
+        row = slice(A.indptr[j], A.indptr[j + 1])
+        model += pulp.lpSum([coef * v[k] for k, coef in zip(A.indices[row], A.data[row])]) >= r[j, 0]
         
     # Solve our problem
     model.solve()
     
-    if pulp.LpStatus[model.status] == 'Optimal':
-        v_final = [v[i].varValue for i in range(mdp.nb_s)]
-    else:
+    if pulp.LpStatus[model.status] != 'Optimal':
         print("No optimal solution found, status =", pulp.LpStatus[model.status])
+        return None
+    return np.array([v[i].varValue for i in range(nb_s)])
+
+def greedy_policy(mdp, v):
+    """ Policy maximizing R + gamma*P.v, size nb_s x 1 """
+    Q = mdp.rewards + mdp.gamma * mdp.expected_values(v)
+    return np.argmax(Q, axis=1).reshape(mdp.nb_s, 1)
+
+def LP_constraint_generation_DMDP(mdp, solver='highs-ipm', tol=1e-7, nb_sweeps=10,
+                                  max_rounds=100, analyze=False, v_init=None, pi_init=None):
+    """ Solve the DMDP with its linear program, by constraint generation
+        - start from one constraint per state: the greedy action after nb_sweeps
+          sweeps of value iteration
+        - solve, look for the violated constraints (s, a) with one vectorized
+          computation of Q = R + gamma*P.v, add them and solve again
+          until no constraint is violated by more than tol
+        - analyze: also return the number of constraints of each round
+        - v_init: value function the sweeps start from (0 by default)
+        - pi_init: policy whose constraints are also in the first round """
+    v = np.zeros((mdp.nb_s, 1)) if v_init is None else np.array(v_init, dtype=float).reshape(mdp.nb_s, 1)
+    for k in range(nb_sweeps):
+        v, _ = bellman_backup(mdp, v)
+    pi = greedy_policy(mdp, v[:, 0])
+
+    active = np.zeros((mdp.nb_s, mdp.nb_a), dtype=bool)
+    active[np.arange(mdp.nb_s), pi[:, 0].astype(int)] = True
+    if pi_init is not None:
+        active[np.arange(mdp.nb_s), np.ravel(pi_init).astype(int)] = True
+    nb_constraints = []
+
+    for k in range(max_rounds):
+        states, actions = np.nonzero(active)
+        nb_constraints.append(len(states))
+        A, r = LP_param_pairs(mdp, states, actions)
+        v_final = solve_LP(A, r, mdp.nb_s, solver)
+        if v_final is None:
+            return (None, None, nb_constraints) if analyze else (None, None)
+
+        Q = mdp.rewards + mdp.gamma * mdp.expected_values(v_final)
+        violated = (Q - v_final[:, None] > tol) & ~active
+        if not np.any(violated):
+            break
+        active |= violated
+    else:
+        print('Constraint generation not finished in {} rounds'.format(max_rounds))
+
+    pi = np.argmax(Q, axis=1).reshape(mdp.nb_s, 1)
+
+    if analyze:
+        return v_final, pi, nb_constraints
+    return v_final, pi
+
+def LP_solving_DMDP(mdp, solver='highs-ipm'):
+    """ Solve the DMDP with its linear program
+        - solver: HiGHS method (sparse, in-process with scipy) or 'pulp' """
+    A, r = LP_param_DMDP(mdp)
+    v_final = solve_LP(A, r, mdp.nb_s, solver)
+    if v_final is None:
+        return None, None
 
     # Compute corresponding pi
-    pi = np.zeros((mdp.nb_s, 1))
-    for state in range(mdp.nb_s):
-        values = [mdp.rewards[state, action] \
-                  + mdp.gamma * mdp.transition[state, action, :].dot(v_final)
-                  for action in range(mdp.nb_a)]
-        pi[state, 0] = np.argmax(values)
-
-    return np.array(v_final), np.array(pi)
\ No newline at end of file
+    pi = greedy_policy(mdp, v_final)
+
+    return v_final, pi
@@ -0,0 +1,94 @@
+import numpy as np
+import json
+import os
+
+from Approximate_DMDP.DMDP_class import DMDP, Sparse_transition, PRECISIONS
+
+
+HEADER = 'header.json'
+CHUNK_SIZE = 2**26  # Size (bytes) of the chunks of transitions copied at once
+
+
+def _chunk_states(nb_s, state_size):
+    """ Number of states whose transitions take about CHUNK_SIZE bytes """
+    return max(1, int(CHUNK_SIZE // max(state_size, 1)))
+
+
+def create_DMDP_files(path, nb_a, nb_s, gamma, M, nnz=None, precision='double'):
+    """ Create the files of an on-disk DMDP in the directory path, to be filled by chunks
+        - nnz: number of nonzero transitions for a sparse DMDP, dense if None
+        - precision: the transitions (and next states) are stored with its types
+          (see PRECISIONS), so that open_DMDP maps them without a copy
+        - return a dict of writable memory-mapped arrays: 'rewards' and
+          'transition' (dense) or 'indptr', 'indices', 'probs' (sparse) """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '{}', should be in {}".format(precision, list(PRECISIONS)))
+    os.makedirs(path, exist_ok=True)
+    header = {'nb_s': int(nb_s), 'nb_a': int(nb_a), 'gamma': float(gamma), 'M': np.asarray(M).item(),
+              'format': 'dense' if nnz is None else 'sparse', 'precision': precision}
+    with open(os.path.join(path, HEADER), 'w') as f:
+        json.dump(header, f)
+
+    dtypes = PRECISIONS[precision]
+    shapes = {'rewards': ((nb_s, nb_a), np.float64)}
+    if nnz is None:
+        shapes['transition'] = ((nb_s, nb_a, nb_s), dtypes['transition'])
+    else:
+        shapes['indptr'] = ((nb_s * nb_a + 1,), np.int64)
+        shapes['indices'] = ((nnz,), dtypes['index'])
+        shapes['probs'] = ((nnz,), dtypes['transition'])
+
+    return {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                            dtype=dtype, shape=shape)
+            for name, (shape, dtype) in shapes.items()}
+
+
+def save_DMDP(mdp, path, precision=None):
+    """ Write mdp in the directory path as .npy files plus a small header,
+        copying the transitions by chunks of states
+        - precision: types of the files (see create_DMDP_files), mdp.precision by default """
+    nnz = mdp.transition.nnz if mdp.is_sparse else None
+    files = create_DMDP_files(path, mdp.nb_a, mdp.nb_s, mdp.gamma, mdp.M, nnz,
+                              mdp.precision if precision is None else precision)
+    files['rewards'][:] = mdp.rewards
+
+    if mdp.is_sparse:
+        P = mdp.transition
+        files['indptr'][:] = P.indptr
+        step = _chunk_states(mdp.nb_s, (P.indices.itemsize + P.probs.itemsize) * nnz / mdp.nb_s)
+        for start in range(0, mdp.nb_s, step):
+            stop = min(start + step, mdp.nb_s)
+            first, last = P.indptr[start * mdp.nb_a], P.indptr[stop * mdp.nb_a]
+            files['indices'][first:last] = P.indices[first:last]
+            files['probs'][first:last] = P.probs[first:last]
+    else:
+        step = _chunk_states(mdp.nb_s, mdp.transition.itemsize * mdp.nb_a * mdp.nb_s)
+        for start in range(0, mdp.nb_s, step):
+            files['transition'][start:start + step] = mdp.transition[start:start + step]
+
+    for array in files.values():
+        array.flush()
+
+
+def open_DMDP(path, mode='r', precision=None):
+    """ Open the DMDP stored in the directory path without loading it:
+        the rewards and the transitions are memory-mapped (np.memmap)
+        - mode: 'r' read-only, 'r+' to modify the files in place
+        - precision: see DMDP, the precision of the files by default; the
+          transitions stay memory-mapped only if the files already have its
+          types (see create_DMDP_files), otherwise they are copied in memory """
+    with open(os.path.join(path, HEADER)) as f:
+        header = json.load(f)
+    nb_s, nb_a = header['nb_s'], header['nb_a']
+
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+
+    if header['format'] == 'sparse':
+        P = Sparse_transition(nb_s, nb_a, load('indptr'), load('indices'), load('probs'))
+    else:
+        P = load('transition')
+
+    if precision is None:
+        precision = header.get('precision')
+    return DMDP(nb_a, nb_s, load('rewards'), P, header['gamma'], M=header['M'], precision=precision)
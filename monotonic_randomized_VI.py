@@ -1,61 +1,89 @@
 import numpy as np
+import contextlib
 import math
+import time
 from tqdm import tqdm
 
-from Approximate_DMDP.randomized_value_iteration import apx_val, apx_trans
+from Approximate_DMDP.randomized_value_iteration import apx_val, apx_trans_all, nb_samples, \
+    _bernstein_report
+from Approximate_DMDP.instrumentation import sample_count, hoeffding_count
+from Approximate_DMDP.value_iteration import initial_error
 
 
-def apx_mon_val(mdp, u, pi, v0, x, eps, delta):
+def apx_mon_val(mdp, u, pi, v0, x, eps, delta, pool=None, bernstein=False):
     """ Monotonic Random Value Operator """
-    v_tilde = np.zeros((mdp.nb_s, 1))
-    pi_tilde = np.zeros((mdp.nb_s, 1))
-    q, w = apx_val(mdp, u, v0, x, eps, delta)
-
-    for i in range(mdp.nb_s):
-        if q[i, 0] - 2 * mdp.gamma * eps > u[i, 0]:
-            v_tilde[i, 0] = q[i, 0] - 2 * mdp.gamma * eps
-            pi_tilde[i, 0] = w[i, 0]
-        else:
-            v_tilde[i, 0] = u[i, 0]
-            pi_tilde[i, 0] = pi[i, 0]
+    q, w = apx_val(mdp, u, v0, x, eps, delta, pool=pool, bernstein=bernstein)
+
+    improved = q - 2 * mdp.gamma * eps > u
+    v_tilde = np.where(improved, q - 2 * mdp.gamma * eps, u)
+    pi_tilde = np.where(improved, w, pi)
 
     return v_tilde, pi_tilde
 
-def sample_randomize_mon_VI(mdp, v0, pi0, T, eps, delta, analyze=False):
-    """ Monotonic Sampled Randomized Value Iteration """
+def sample_randomize_mon_VI(mdp, v0, pi0, T, eps, delta, analyze=False, pool=None, recorder=None,
+                            bernstein=False):
+    """ Monotonic Sampled Randomized Value Iteration
+        - recorder: Recorder receiving the 'trans' and 'iteration' events
+        - bernstein: adapt the number of samples to each pair (see apx_trans_block) """
 
     m_hist = []
 
     # Sample to obtain x approximation of p.v0
-    x = np.zeros((mdp.nb_s, mdp.nb_a))
-    for i in range(mdp.nb_s):
-        for a in range(mdp.nb_a):
-            x[i, a] = apx_trans(mdp, v0, np.max(v0), i, a, eps, delta)
+    start_time_x = time.time()
+    if recorder is not None:
+        samples_x = sample_count(mdp, pool)
+    x = apx_trans_all(mdp, v0, np.max(np.abs(v0)), eps, delta, pool=pool, bernstein=bernstein)
+
+    if recorder is not None:
+        recorder.record('trans', duration=time.time() - start_time_x,
+                        m=nb_samples(np.max(np.abs(v0)), eps, delta),
+                        samples=sample_count(mdp, pool) - samples_x)
 
     v_t = v0
     pi_t = pi0
     for t in range(T):
-        v_t, pi_t = apx_mon_val(mdp, v_t, pi_t, v0, x, eps/2, delta/T)
-
+        start_time_t = time.time()
+        if recorder is not None:
+            samples_t = sample_count(mdp, pool)
+        v_prev = v_t
+        v_t, pi_t = apx_mon_val(mdp, v_t, pi_t, v0, x, eps/2, delta/T, pool, bernstein)
+        m = nb_samples(np.max(np.abs(v_prev - v0)), eps/2, delta / (T * mdp.nb_s * mdp.nb_a))
+
+        if recorder is not None:
+            recorder.record('iteration', l=t, duration=time.time() - start_time_t, m=m,
+                            samples=sample_count(mdp, pool) - samples_t,
+                            residual=float(np.max(np.abs(v_t - v_prev))))
         if analyze:
-            m = int(2 * np.max(np.abs(v_t - v0))**2 / (eps**2/4) \
-                * np.log(2 / (delta/T))) + 1
             m_hist.append(m)
 
     return v_t, pi_t, m_hist
         
-def sublinear_random_mon_VI(mdp, eps, delta, analyze=False):
-    """ Montonic Sublinear Time Randomized Value Iteration """
+def sublinear_random_mon_VI(mdp, eps, delta, analyze=False, pool=None, recorder=None,
+                            v_init=None, pi_init=None, err_init=None, bernstein=False):
+    """ Montonic Sublinear Time Randomized Value Iteration
+        - pool: Sweep_pool to shard the states across processes
+        - recorder: Recorder receiving the timings, samples drawn and residuals
+          of every iteration (see instrumentation)
+        - v_init, pi_init, err_init: warm start from the value function v_init
+          and the policy pi_init (v_init should be a lower bound of the value of
+          pi_init for the iterates to stay monotonic), with |v_init - v*|_inf <=
+          err_init (see initial_error by default), which sets the number of
+          outer iterations
+        - bernstein: adapt the number of samples of each pair (i, a), reported
+          in analysis['bernstein'] (see _bernstein_report) """
 
     analysis = {}
-    K = math.log(mdp.M / (eps * (1 - mdp.gamma)), 2)
-    K = int(K) + 1
+    if err_init is None:
+        err_init = mdp.M / (1 - mdp.gamma) if v_init is None else initial_error(mdp, v_init)
+    K = math.log(err_init / eps, 2)
+    K = max(int(K) + 1, 1)
     T = 1. / (1 - mdp.gamma) * math.log(4. / (1 - mdp.gamma))
     T = int(T) + 1
 
-    v_k = np.zeros((mdp.nb_s, 1))
-    pi_k = np.zeros((mdp.nb_a, 1))
-    eps_k = mdp.M / (1 - mdp.gamma)
+    v_k = np.zeros((mdp.nb_s, 1)) if v_init is None else np.array(v_init, dtype=float).reshape(mdp.nb_s, 1)
+    pi_k = np.zeros((mdp.nb_s, 1), dtype=mdp.dtypes['policy']) if pi_init is None \
+        else np.array(pi_init, dtype=mdp.dtypes['policy']).reshape(mdp.nb_s, 1)
+    eps_k = err_init
 
     if analyze:
         analysis['K'] = K
@@ -66,14 +94,28 @@ def sublinear_random_mon_VI(mdp, eps, delta, analyze=False):
         analysis['V_hist'] = []
         analysis['pi_hist'] = []
 
+    if recorder is not None:
+        recorder.record('setup', K=K, T=T, eps=eps, delta=delta, M=mdp.M,
+                        nb_s=mdp.nb_s, nb_a=mdp.nb_a, gamma=mdp.gamma)
+
+    samples_start, hoeffding_start = sample_count(mdp, pool), hoeffding_count(mdp, pool)
     for k in tqdm(range(K)):
+        start_time_k = time.time()
         eps_k = 0.5 * eps_k
-        v_k, pi_k, m_hist = sample_randomize_mon_VI(mdp, v_k, pi_k, T,
-            (1 - mdp.gamma)*eps/(4*mdp.gamma), delta/K, analyze)
+        samples_k = sample_count(mdp, pool)
+        with (recorder.scope(k=k) if recorder else contextlib.nullcontext()):
+            v_k, pi_k, m_hist = sample_randomize_mon_VI(mdp, v_k, pi_k, T,
+                (1 - mdp.gamma)*eps/(4*mdp.gamma), delta/K, analyze, pool, recorder, bernstein)
+        if recorder is not None:
+            recorder.record('outer', k=k, duration=time.time() - start_time_k, eps_k=eps_k,
+                            samples=sample_count(mdp, pool) - samples_k)
 
         if analyze:
             analysis['m_hist'].append(m_hist)
             analysis['V_hist'].append(v_k)
             analysis['pi_hist'].append(pi_k)
 
+    if bernstein:
+        analysis['bernstein'] = _bernstein_report(mdp, pool, samples_start, hoeffding_start)
+
     return v_k, pi_k, analysis
\ No newline at end of file
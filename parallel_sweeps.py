@@ -0,0 +1,124 @@
+import numpy as np
+from multiprocessing import Pool, shared_memory
+
+from Approximate_DMDP.DMDP_class import DMDP, Sparse_transition
+from Approximate_DMDP.randomized_value_iteration import apx_trans_block, MEMORY_BUDGET
+
+
+SHARD_SIZE = 256  # Number of states of a task, fixed so that results do not depend on the workers
+
+_worker = {}  # Shared arrays and DMDP of the current worker process
+
+
+def _init_worker(specs, meta):
+    """ Attach the shared memory blocks and build a DMDP on top of them """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker[name + '_block'] = block
+        _worker[name] = np.ndarray(shape, dtype, buffer=block.buf)
+
+    nb_s, nb_a, gamma, is_sparse = meta
+    if is_sparse:
+        P = Sparse_transition(nb_s, nb_a, _worker['indptr'], _worker['indices'], _worker['probs'])
+    else:
+        P = _worker['transition']
+    _worker['mdp'] = DMDP(nb_a, nb_s, _worker['rewards'], P, gamma)
+
+
+def _expected_values_task(shard):
+    start, stop = shard
+    _worker['out'][start:stop] = _worker['mdp'].expected_values(_worker['v'], start, stop)
+
+
+def _apx_trans_task(args):
+    """ Return the number of samples drawn and the Hoeffding number of the shard """
+    (start, stop), M, eps, delta, memory_budget, seed, bernstein = args
+    mdp = _worker['mdp']
+    drawn, hoeffding = mdp.nb_samples, mdp.nb_samples_hoeffding
+    _worker['out'][start:stop] = apx_trans_block(mdp, _worker['v'][:, None], M,
+                                                 start, stop, eps, delta, memory_budget,
+                                                 rng=np.random.default_rng(seed),
+                                                 bernstein=bernstein)
+    return mdp.nb_samples - drawn, mdp.nb_samples_hoeffding - hoeffding
+
+
+class Sweep_pool:
+    """
+    Process pool sharding the states of a DMDP across workers, for the exact
+    expectations p_a(i)^T v and the sampled ones of apx_trans.
+
+    The rewards, the transitions, the input vector and the output array live in
+    shared memory, so that nothing but the shard bounds is pickled. Each shard of
+    shard_size states draws from its own random stream, spawned from seed for
+    every call: results only depend on seed, not on the number of workers.
+
+    Use as a context manager, or call close() to release the shared memory.
+    
+    """
+
+    def __init__(self, mdp, n_workers=None, seed=None, shard_size=SHARD_SIZE):
+
+        self.nb_s = mdp.nb_s
+        self.nb_a = mdp.nb_a
+        self.shards = [(start, min(start + shard_size, mdp.nb_s))
+                       for start in range(0, mdp.nb_s, shard_size)]
+        self.seed = np.random.SeedSequence(seed)
+        self.nb_samples = 0  # Number of next states drawn by the workers
+        self.nb_samples_hoeffding = 0  # Number the Hoeffding sample sizes ask for
+
+        arrays = {'rewards': mdp.rewards,
+                  'v': np.zeros(mdp.nb_s),
+                  'out': np.zeros((mdp.nb_s, mdp.nb_a))}
+        if mdp.is_sparse:
+            arrays['indptr'] = mdp.transition.indptr
+            arrays['indices'] = mdp.transition.indices
+            arrays['probs'] = mdp.transition.probs
+        else:
+            arrays['transition'] = mdp.transition
+
+        self._blocks = []
+        specs = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+            view[...] = array
+            self._blocks.append(block)
+            specs[name] = (block.name, array.shape, array.dtype.str)
+            if name in ('v', 'out'):
+                setattr(self, '_' + name, view)
+
+        meta = (mdp.nb_s, mdp.nb_a, mdp.gamma, mdp.is_sparse)
+        self.pool = Pool(n_workers, initializer=_init_worker, initargs=(specs, meta))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self._v = self._out = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def expected_values(self, v):
+        """ p_a(i)^T v for every pair (i, a), size nb_s x nb_a """
+        self._v[:] = v
+        self.pool.map(_expected_values_task, self.shards)
+        return self._out.copy()
+
+    def apx_trans(self, u, M, eps, delta, memory_budget=MEMORY_BUDGET, bernstein=False):
+        """ Approximate Transition (see apx_trans_all) for every pair (i, a),
+            size nb_s x nb_a """
+        self._v[:] = u[:, 0]
+        seeds = self.seed.spawn(len(self.shards))
+        counts = self.pool.map(_apx_trans_task, [(shard, M, eps, delta, memory_budget, seed, bernstein)
+                                                 for shard, seed in zip(self.shards, seeds)])
+        self.nb_samples += sum(drawn for drawn, _ in counts)
+        self.nb_samples_hoeffding += sum(hoeffding for _, hoeffding in counts)
+        return self._out.copy()
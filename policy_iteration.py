@@ -0,0 +1,102 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve, bicgstab
+
+from Approximate_DMDP.value_iteration import bellman_backup
+
+
+def policy_system(mdp, pi):
+    """ Sparse P_pi (nb_s x nb_s) and r_pi (size nb_s) of the deterministic policy pi """
+    states = np.arange(mdp.nb_s)
+    actions = np.asarray(pi).reshape(mdp.nb_s).astype(int)
+    return mdp.transition_matrix(states, actions), np.asarray(mdp.rewards[states, actions], dtype=float)
+
+
+def policy_evaluation(mdp, pi, method='direct', tol=1e-10, v_init=None):
+    """ Value of the deterministic policy pi (nb_s x 1), solving (I - gamma*P_pi) v = r_pi
+        - method: 'direct' (sparse LU) or 'bicgstab' (iterative, relative tolerance tol,
+          starting from v_init)
+        - return v of size nb_s x 1 """
+    P_pi, r_pi = policy_system(mdp, pi)
+    A = sp.identity(mdp.nb_s, format='csr') - mdp.gamma * P_pi
+
+    if method == 'direct':
+        v = spsolve(A.tocsc(), r_pi)
+    elif method == 'bicgstab':
+        x0 = None if v_init is None else v_init[:, 0]
+        v, info = bicgstab(A, r_pi, x0, rtol=tol)
+        if info > 0:
+            print('bicgstab did not converge in {} iterations'.format(info))
+    else:
+        raise ValueError("Unknown method '{}', expected 'direct' or 'bicgstab'".format(method))
+
+    return v.reshape(mdp.nb_s, 1)
+
+
+def run_policy_iteration(mdp, iter_max=100, method='direct', keep_history=False, pi_init=None):
+    """ Policy iteration of a MDP to find the optimal policy and its evaluation V
+        - each policy is evaluated exactly (see policy_evaluation), then improved
+          greedily; only the states strictly improved by a new action change it
+        keep_history -> to keep the convergence history and plot it
+        pi_init -> initial policy (greedy with respect to 0 by default) """
+    V = np.zeros((mdp.nb_s, 1))
+    if pi_init is None:
+        _, pi = bellman_backup(mdp, V)
+    else:
+        pi = np.array(pi_init, dtype=mdp.dtypes['policy']).reshape(mdp.nb_s, 1)
+    if keep_history:
+        V_hist = []
+
+    for k in range(iter_max):
+        V = policy_evaluation(mdp, pi, method, v_init=V)
+        if keep_history:
+            V_hist.append(V.copy())
+
+        V_new, pi_new = bellman_backup(mdp, V)
+        # a gap left by the evaluation error (tol with 'bicgstab') alone is not an improvement
+        improved = (V_new > V + 1e-12 * np.maximum(1, np.abs(V))) & (pi_new != pi)
+        if not np.any(improved):
+            break
+        pi = np.where(improved, pi_new, pi)
+    else:
+        print('NO CONVERGENCE in {} iterations'.format(iter_max))
+
+    if keep_history:
+        return pi, V, V_hist
+    else:
+        return pi, V
+
+
+def run_modified_policy_iteration(mdp, eps, nb_eval=20, iter_max=1000, keep_history=False,
+                                  v_init=None):
+    """ Modified policy iteration of a MDP to find an eps-optimal policy and its evaluation V
+        - each greedy policy is partially evaluated with nb_eval applications
+          of v <- r_pi + gamma*P_pi.v
+        - stops when |T(V) - V|_inf < eps*(1 - gamma)/(2*gamma)
+        keep_history -> to keep the convergence history and plot it
+        v_init -> initial value function (0 by default) """
+    threshold = eps * (1 - mdp.gamma) / (2 * mdp.gamma)
+    V = np.zeros((mdp.nb_s, 1)) if v_init is None else np.array(v_init, dtype=float).reshape(mdp.nb_s, 1)
+    if keep_history:
+        V_hist = [V]
+
+    for k in range(iter_max):
+        V_new, pi = bellman_backup(mdp, V)
+        residual = np.max(np.abs(V_new - V))
+        V = V_new
+        if residual < threshold:
+            break
+
+        P_pi, r_pi = policy_system(mdp, pi)
+        for j in range(nb_eval - 1):
+            V = r_pi[:, None] + mdp.gamma * (P_pi @ V)
+
+        if keep_history:
+            V_hist.append(V.copy())
+    else:
+        print('NO CONVERGENCE in {} iterations'.format(iter_max))
+
+    if keep_history:
+        return pi, V, V_hist
+    else:
+        return pi, V
@@ -2,7 +2,7 @@ import numpy as np
 import math
 from tqdm import tqdm
 
-from sampling_tree import Sampling_tree, Sampling_tree_with_policy_updates
+from Approximate_DMDP.sampling_tree import Alias_table, Sampling_tree_with_policy_updates
 
 
 
@@ -19,9 +19,21 @@ class Randomized_Primal_Dual:
         self.gamma = gamma
         
         self.r = rewards # shape (state, action)
-        self.p = transition_probabilities # shape (state, action, next_state)
+        self.p = transition_probabilities # shape (state, action, next_state) or Sparse_transition
+        self.sparse = hasattr(transition_probabilities, 'indptr')
+        self.simulator = None # Simulator_DMDP drawing the next states, see from_DMDP
         
-    def preprocess(self, T):
+    @classmethod
+    def from_DMDP(cls, mdp):
+        """ Primal-dual method on a DMDP, or on a Simulator_DMDP whose next states
+            are drawn by its sampler (one per step) instead of alias tables """
+        if not hasattr(mdp, 'sample_next'):
+            return cls(mdp.nb_s, mdp.nb_a, mdp.rewards, mdp.transition, mdp.gamma)
+        rpd = cls(mdp.nb_s, mdp.nb_a, mdp.rewards, None, mdp.gamma)
+        rpd.simulator = mdp
+        return rpd
+        
+    def preprocess(self, T, v_init=None, pi_init=None):
         
         self.q = np.ones(self.s) / self.s
         self.xi = np.ones(self.s) / self.s
@@ -33,31 +45,66 @@ class Randomized_Primal_Dual:
         self.alpha = self.beta*self.s / (2*(1-self.gamma)**2)
         self.M = 1 / (1-self.gamma)
         
+        if v_init is not None:
+            self.v = np.clip(np.array(v_init, dtype=float).reshape(self.s), 0, self.M)
+        if pi_init is not None:
+            pi_init = np.asarray(pi_init)
+            if pi_init.shape != (self.s, self.a):
+                # deterministic policy, mixed with the uniform one to keep every action
+                pi_init = np.eye(self.a)[np.ravel(pi_init).astype(int)]
+                pi_init = (1-self.theta)*pi_init + self.theta/self.a
+            self.pi = pi_init / np.sum(pi_init, axis=1, keepdims=True)
+        
         self.sample_i = Sampling_tree_with_policy_updates(list((1-self.theta)*self.xi + self.theta*self.q))
         
         sample_a = []
         sample_j = []
+        next_j = [] # next states of the sparse rows, sampled by position
         
         for i in range(self.s):
             
-            sample_a.append(Sampling_tree_with_policy_updates(list(self.pi[0, :])))
+            sample_a.append(Sampling_tree_with_policy_updates(list(self.pi[i, :])))
             sample_j.append([])
+            next_j.append([])
             
             for a in range(self.a):
                 
-                sample_j[i].append(Sampling_tree(list(self.p[i, a, :])))
+                if self.simulator is not None:
+                    
+                    continue
+                
+                elif self.sparse:
+                    
+                    indices, probs = self.p.row(i, a)
+                    sample_j[i].append(Alias_table(probs))
+                    next_j[i].append(indices)
+                
+                else:
+                    
+                    sample_j[i].append(Alias_table(self.p[i, a, :]))
                 
         self.sample_a = sample_a
         self.sample_j = sample_j
+        self.next_j = next_j
         
         print("finished preprocessing")
         
         
-    def run(self, T):
+    def run(self, T, v_init=None, pi_init=None):
+        """ Run T steps and return the average policy, of size nb_s x nb_a
+            - v_init: initial dual values, clipped to [0, 1/(1 - gamma)]
+            - pi_init: initial policy, nb_s x nb_a with positive probabilities,
+              or nb_s x 1 deterministic (then mixed with the uniform policy) """
         
-        self.preprocess(T)
+        self.preprocess(T, v_init, pi_init)
         
+        # xi is kept unnormalized with its total xi_sum, and the average policy is
+        # accumulated lazily: pi[i, :] is added for all the steps since last_update[i]
+        # only when it changes, so that each step costs O(A + log S)
         average_policy = np.zeros((self.s, self.a))
+        last_update = np.zeros(self.s, dtype=np.int64)
+        self.xi_sum = np.sum(self.xi)
+        rng = np.random.default_rng(np.random.randint(2**31)) # next states of a simulator
         
         for t in tqdm(range(T)):
             
@@ -67,28 +114,45 @@ class Randomized_Primal_Dual:
             
             i = self.sample_i.sample()
             a = self.sample_a[i].sample()
-            j = self.sample_j[i][a].sample()
+            if self.simulator is not None:
+                j = self.simulator.step_batch(i, a, 1, rng)[0, 0]
+            else:
+                j = self.sample_j[i][a].sample()
+            if self.sparse:
+                j = self.next_j[i][a][j]
             
             # update
             
-            p_i = (1-self.theta)*self.xi[i] + self.theta*self.q[i]
+            xi_i = self.xi[i] / self.xi_sum
+            p_i = (1-self.theta)*xi_i + self.theta*self.q[i]
             
             delta = self.beta*(self.gamma*self.v[j] - self.v[i] + self.r[i, a] - self.M) / p_i / self.pi[i, a] # r
             self.v[i] = max(min(self.v[i] - self.alpha*(self.theta*self.q[i]/p_i - 1), self.M), 0)
             self.v[j] = max(min(self.v[j] - self.alpha*self.gamma, self.M), 0)
             
-            new_xi_i = self.xi[i]*(1 + self.pi[i, a]*(np.exp(delta)-1))
+            new_xi_i = xi_i*(1 + self.pi[i, a]*(np.exp(delta)-1))
             new_pi_ia = self.pi[i, a]*np.exp(delta)
             
             self.sample_i.update_weights(new_xi_i)
             self.sample_a[i].update_weights(new_pi_ia)
             
-            self.xi[i] = new_xi_i
+            average_policy[i, :] += (t - last_update[i])*self.pi[i, :]
+            last_update[i] = t
+            
+            new_xi_raw = new_xi_i*self.xi_sum
+            self.xi_sum += new_xi_raw - self.xi[i]
+            self.xi[i] = new_xi_raw
             self.pi[i, a] = new_pi_ia
             
-            self.xi = self.xi / np.sum(self.xi)
             self.pi[i, :] = self.pi[i, :] / np.sum(self.pi[i, :])
             
-            average_policy += self.pi
+            if not 1e-100 < self.xi_sum < 1e100:
+                
+                self.xi = self.xi / self.xi_sum
+                self.xi_sum = 1.
+        
+        average_policy += (T - last_update)[:, None]*self.pi
+        self.xi = self.xi / self.xi_sum
+        self.xi_sum = 1.
         
         return average_policy / T
\ No newline at end of file
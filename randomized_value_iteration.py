@@ -1,5 +1,73 @@
 import numpy as np
 import time
+from collections import OrderedDict
+
+from Approximate_DMDP.instrumentation import sample_count, hoeffding_count
+from Approximate_DMDP.value_iteration import initial_error
+
+
+MEMORY_BUDGET = 2**27  # Peak memory (bytes) allowed for the next-state samples of a batch
+SAMPLE_SIZE = 32  # Bytes used per sample while drawing (index, uniform and search)
+BANK_SIZE = 2**29  # Memory cap (bytes) of the samples kept by a Sample_bank
+BERNSTEIN_ROUND = 32  # Samples per pair of the first round of the empirical Bernstein estimator
+
+
+def nb_samples(M, eps, delta):
+    """ Number of samples m given by Hoeffding for an eps-approximation
+        with probability 1 - delta of values in [-M, M] """
+    return int(2 * M**2 / (eps**2) * np.log(2 / delta)) + 1
+
+
+class Sample_bank:
+    """ Next-state samples of every pair (i, a), drawn once and reused by the
+        successive calls of apx_val (the distributions p_a(i) never change).
+        - samples are stored as int32 arrays by blocks of mdp.table_block states,
+          and a block only draws new samples when a larger m is needed
+        - blocks are evicted least recently used first above memory_cap bytes, and
+          a block whose m samples alone exceed memory_cap is not kept
+
+        Reusing the samples makes the estimates of the different iterations
+        dependent, so the probability 1 - delta of the solvers is not guaranteed
+        anymore when a bank is used.
+    """
+
+    def __init__(self, mdp, memory_cap=BANK_SIZE):
+        self.mdp = mdp
+        self.memory_cap = memory_cap
+        self.block = mdp.table_block
+        self._samples = OrderedDict()
+        self._bytes = 0
+
+    def samples(self, start, stop, m, memory_budget=MEMORY_BUDGET):
+        """ m samples of each pair of the block of states starting at start,
+            size (stop - start)*nb_a x m
+            - the new samples are drawn by chunks fitting in memory_budget
+            - return None if they would not fit in memory_cap: the caller draws
+              fresh samples by chunks instead """
+        assert(start % self.block == 0)
+        nb_rows = (stop - start) * self.mdp.nb_a
+        if nb_rows * m * np.dtype(np.int32).itemsize > self.memory_cap:
+            return None
+        bank = self._samples.pop(start, None)
+        if bank is None:
+            bank = np.empty((nb_rows, 0), dtype=np.int32)
+        else:
+            self._bytes -= bank.nbytes
+
+        if bank.shape[1] < m:
+            have = bank.shape[1]
+            bank = np.hstack((bank, np.empty((nb_rows, m - have), dtype=np.int32)))
+            chunk = max(1, memory_budget // (SAMPLE_SIZE * nb_rows))
+            for done in range(have, m, chunk):
+                bank[:, done:min(done + chunk, m)] = self.mdp.step_block(start, stop, min(chunk, m - done))
+
+        while self._bytes + bank.nbytes > self.memory_cap:
+            _, old = self._samples.popitem(last=False)
+            self._bytes -= old.nbytes
+        self._samples[start] = bank
+        self._bytes += bank.nbytes
+
+        return bank[:, :m]
 
 
 def apx_trans(mdp, u, M, i, a, eps, delta):
@@ -7,65 +75,273 @@ def apx_trans(mdp, u, M, i, a, eps, delta):
         - give an eps-approxiamtion of p_a(i)^T v_i
     """
     assert(np.max(u) <= M)
-    m = int(2 * M**2 / (eps**2) * np.log(2 / delta)) + 1
-    result = 0
+    m = nb_samples(M, eps, delta)
+    next_states = mdp.step_batch(i, a, m)[0]
+
+    return np.sum(u[next_states, 0]) / m
+
+
+def _value_ranges(mdp, u, start, stop):
+    """ max - min of u over the successors of each pair (i, a) of a sparse DMDP
+        with start <= i < stop """
+    seg = mdp.transition.indptr[start * mdp.nb_a:stop * mdp.nb_a + 1]
+    values = u[mdp.transition.indices[seg[0]:seg[-1]], 0]
+    first = seg[:-1] - seg[0]
+    return np.maximum.reduceat(values, first) - np.minimum.reduceat(values, first)
+
+
+def _apx_trans_bernstein(mdp, u, M, start, stop, eps, delta, memory_budget=MEMORY_BUDGET,
+                         rng=None):
+    """ Approximate Transition with a number of samples adapted to each pair
+        - the pairs are sampled in rounds of BERNSTEIN_ROUND*2^j samples, and a pair
+          stops as soon as the empirical Bernstein bound (Audibert et al. 2009)
+          sqrt(2*var*log(3/d)/n) + 3*R*log(3/d)/n <= eps, where var is the
+          empirical variance and R the range of its values, or when it reaches the
+          Hoeffding sample size for the range R
+        - R = max - min of u over the successors for a sparse DMDP, 2*M otherwise
+        - each pair makes at most J checks, with J the number of rounds up to the
+          Hoeffding m of apx_trans_block, and every check uses d = delta/J: the
+          estimates are eps-accurate with probability 1 - delta
+        - return an array of size (stop - start) x nb_a
+    """
+    nb_rows = (stop - start) * mdp.nb_a
+    rows = np.arange(start * mdp.nb_a, stop * mdp.nb_a)
+    m = nb_samples(M, eps, delta)
+    checkpoints = [BERNSTEIN_ROUND * 2**j for j in range(64) if BERNSTEIN_ROUND * 2**j < m]
+    delta_check = delta / (len(checkpoints) + 1)
+    log_term = np.log(3 / delta_check)
+
+    R = _value_ranges(mdp, u, start, stop) if mdp.is_sparse else np.full(nb_rows, 2. * M)
+    cap = (2 * (R / 2)**2 / eps**2 * np.log(2 / delta_check)).astype(np.int64) + 1
+
+    n = np.zeros(nb_rows, dtype=np.int64)
+    mean = np.zeros(nb_rows)
+    M2 = np.zeros(nb_rows)  # sum of the squared deviations to the mean
+    active = np.ones(nb_rows, dtype=bool)
+
+    for target in checkpoints + [np.max(cap)]:
+        act = np.nonzero(active)[0]
+        if len(act) == 0:
+            break
+        k = np.minimum(target, cap[act]) - n[act]  # new samples of each active pair
+        chunk = max(1, memory_budget // (SAMPLE_SIZE * int(np.max(k))))
+
+        for lo in range(0, len(act), chunk):
+            sel, k_sel = act[lo:lo + chunk], k[lo:lo + chunk]
+            values = u[mdp.step_rows(rows[sel], int(np.max(k_sel)), rng), 0]
+            mask = np.arange(values.shape[1]) < k_sel[:, None]
+            batch_mean = np.sum(values * mask, axis=1) / k_sel
+            batch_M2 = np.sum(((values - batch_mean[:, None]) * mask)**2, axis=1)
+
+            # combination of the statistics of the previous and new samples
+            total = n[sel] + k_sel
+            diff = batch_mean - mean[sel]
+            mean[sel] += diff * k_sel / total
+            M2[sel] += batch_M2 + diff**2 * n[sel] * k_sel / total
+            n[sel] = total
+
+        var = M2[act] / n[act]
+        bound = np.sqrt(2 * var * log_term / n[act]) + 3 * R[act] * log_term / n[act]
+        active[act[(bound <= eps) | (n[act] >= cap[act])]] = False
+
+    return mean.reshape(stop - start, mdp.nb_a)
+
+
+def apx_trans_block(mdp, u, M, start, stop, eps, delta, memory_budget=MEMORY_BUDGET,
+                    bank=None, rng=None, bernstein=False):
+    """ Approximate Transition for all the pairs (i, a) with start <= i < stop
+        - the m samples of each pair are drawn by chunks fitting in memory_budget,
+          or taken from the Sample_bank bank
+        - rng: np.random.Generator, the global numpy generator by default
+        - bernstein: adapt the number of samples to each pair (see
+          _apx_trans_bernstein), not with a bank
+        - return an array of size (stop - start) x nb_a
+    """
+    assert(np.max(u) <= M)
+    m = nb_samples(M, eps, delta)
+    mdp.nb_samples_hoeffding += (stop - start) * mdp.nb_a * m
+    if bernstein and bank is None:
+        return _apx_trans_bernstein(mdp, u, M, start, stop, eps, delta, memory_budget, rng)
+    nb_rows = (stop - start) * mdp.nb_a
+    chunk = max(1, memory_budget // (SAMPLE_SIZE * nb_rows))
+    result = np.zeros(nb_rows)
+    samples = None if bank is None else bank.samples(start, stop, m, memory_budget)
+
+    for done in range(0, m, chunk):
+        if samples is None:
+            next_states = mdp.step_block(start, stop, min(chunk, m - done), rng)
+        else:
+            next_states = samples[:, done:done + chunk]
+        result += np.sum(u[next_states, 0], axis=1)
+
+    return result.reshape(stop - start, mdp.nb_a) / m
+
 
-    for k in range(m):
-        j, _ = mdp.step(i, a)
-        result += u[j, 0]
+def apx_trans_all(mdp, u, M, eps, delta, memory_budget=MEMORY_BUDGET, bank=None,
+                  pool=None, bernstein=False):
+    """ Approximate Transition for every pair (i, a), by blocks of states
+        - bank: Sample_bank to reuse the samples of the previous calls
+        - pool: Sweep_pool to shard the states across processes
+        - bernstein: adapt the number of samples to each pair (see apx_trans_block)
+        - return an array of size nb_s x nb_a
+    """
+    if pool is not None and bank is None:
+        assert(np.max(u) <= M)
+        return pool.apx_trans(u, M, eps, delta, memory_budget, bernstein)
+
+    m = nb_samples(M, eps, delta)
+    block = max(1, memory_budget // (SAMPLE_SIZE * mdp.nb_a * m))
+    if bank is not None:
+        block = bank.block
+    result = np.zeros((mdp.nb_s, mdp.nb_a))
 
-    return result / m
+    for start in range(0, mdp.nb_s, block):
+        stop = min(start + block, mdp.nb_s)
+        result[start:stop] = apx_trans_block(mdp, u, M, start, stop, eps, delta,
+                                             memory_budget, bank, bernstein=bernstein)
+
+    return result
 
 
 def exacte_trans(mdp, u, M, i, a, eps, delta):
-    return mdp.transition[i, a, :].dot(u[:, 0])
+    indices, probs = mdp.successors(i, a)
+    return probs.dot(u[indices, 0])
 
 
-def apx_val(mdp, u, v0, x, eps, delta):
+def apx_val(mdp, u, v0, x, eps, delta, memory_budget=MEMORY_BUDGET, bank=None, pool=None,
+            bernstein=False):
     """ Approximate Value Operator
         - Compute policy pi and value function v using value iteration method
           with approximated transition p_a(i).v_i
+        - all the pairs (i, a) are sampled together, by blocks fitting in memory_budget
+        - bank: Sample_bank to reuse the samples of the previous calls
+        - pool: Sweep_pool to shard the states across processes
+        - bernstein: adapt the number of samples to each pair (see apx_trans_block)
     """
     M = np.max(np.abs(u - v0))
     delta2 = delta / (mdp.nb_s * mdp.nb_a)
     v = np.zeros((mdp.nb_s, 1))
-    pi = np.zeros((mdp.nb_s, 1))
+    pi = np.zeros((mdp.nb_s, 1), dtype=mdp.dtypes['policy'])
 
-    for i in range(mdp.nb_s):
-        Q = np.zeros((mdp.nb_a, 1))
-        for a in range(mdp.nb_a):
-            Q[a, 0] = mdp.gamma * \
-                (x[i, a] + apx_trans(mdp, u - v0, M, i, a, eps, delta2))
-            Q[a, 0] += mdp.rewards[i, a]
-        v[i, 0] = np.max(Q[:, 0])
-        pi[i, 0] = np.argmax(Q[:, 0])
+    Q = mdp.gamma * (x + apx_trans_all(mdp, u - v0, M, eps, delta2, memory_budget, bank, pool,
+                                       bernstein))
+    Q += mdp.rewards
+    v[:, 0] = np.max(Q, axis=1)
+    pi[:, 0] = np.argmax(Q, axis=1)
 
     return v, pi
 
 
-def randomizedVI(mdp, v0, L, eps, delta, analyze=False):
+def certified_bound(gamma, residual, err):
+    """ Bound on |v_l - v*|_inf when v_l = T'v_(l-1) for an operator T' within
+        gamma*err of the Bellman operator (estimates of p_a(i)^T v within err):
+        |v_l - v*| <= gamma*err + gamma*(|v_l - v_(l-1)| + |v_l - v*|)
+        - residual: |v_l - v_(l-1)|_inf """
+    return gamma * (residual + err) / (1 - gamma)
+
+
+def _stop(mdp, early_stop, l, residual, samples):
+    """ Update early_stop after the iteration l, which drew samples next states,
+        and tell if the target is reached """
+    early_stop['iterations'] = l + 1
+    early_stop['samples_per_iteration'] = samples
+    early_stop['bound'] = certified_bound(mdp.gamma, residual, early_stop['err'])
+    return early_stop['bound'] <= early_stop['target']
+
+
+def _warm_start(mdp, v0_value, v_init, err_init):
+    """ Start of the outer iterations of the randomized solvers: v_init (instead
+        of the constant v0_value) with |v_init - v*|_inf <= err_init (see
+        initial_error by default), so that they start at eps_k = err_init/2
+        - return v0 (nb_s x 1) and err_init """
+    if v_init is None:
+        v0 = np.zeros((mdp.nb_s, 1)) + v0_value
+        return v0, mdp.M / (1 - mdp.gamma) if err_init is None else err_init
+    v0 = np.array(v_init, dtype=float).reshape(mdp.nb_s, 1)
+    return v0, initial_error(mdp, v0) if err_init is None else err_init
+
+
+def _adaptive_phase(report, early_stop, eps_k, eps, samples):
+    """ Account for an outer iteration of the adaptive mode in report. In this
+        mode, the inner loop stops as soon as the certified bound
+        gamma*(|v_l - v_(l-1)| + err)/(1 - gamma) on |v_l - v*| reaches eps_k (see
+        _stop), and the outer iterations whose eps_k it already reaches are
+        skipped. The bound holds on the event where all the estimates are within
+        their error, so the result stays eps-approximate with probability 1 - delta.
+        - return the number of next outer iterations to skip, whose eps_k is
+          already certified, and whether eps is reached """
+    report['outer_iterations'] += 1
+    report['inner_iterations'] += early_stop['iterations']
+    report['samples'] += samples
+    report['bound'] = early_stop['bound']
+    report['samples_per_iteration'] = early_stop['samples_per_iteration']
+
+    skip = 0
+    while early_stop['bound'] <= eps_k * 0.5**(skip + 1):
+        skip += 1
+    report['skipped_outer'] += skip
+    return skip, early_stop['bound'] <= eps
+
+
+def _adaptive_report(report, K, L):
+    """ Iterations saved with respect to the K*L of the worst-case schedule, and
+        samples saved, underestimated with the samples of the last inner iteration
+        (m grows with |v_l - v0| along the iterations) """
+    report['saved_iterations'] = K * L - report['inner_iterations']
+    report['saved_samples'] = int(report['saved_iterations'] * report.pop('samples_per_iteration', 0))
+    return report
+
+
+def _bernstein_report(mdp, pool, samples_start, hoeffding_start):
+    """ Samples drawn with the empirical Bernstein estimator (see
+        _apx_trans_bernstein, same guarantee as the Hoeffding sample sizes) since
+        the counts samples_start and hoeffding_start, against the samples the
+        Hoeffding sample sizes ask for: 'samples', 'hoeffding_samples' and
+        'saved_samples' """
+    samples, hoeffding = sample_count(mdp, pool) - samples_start, hoeffding_count(mdp, pool) - hoeffding_start
+    return {'samples': samples, 'hoeffding_samples': hoeffding, 'saved_samples': hoeffding - samples}
+
+
+def randomizedVI(mdp, v0, L, eps, delta, analyze=False, pool=None, recorder=None,
+                 early_stop=None, bernstein=False):
+    """ Randomized Value Iteration: L iterations of apx_val around v0, with the
+        exact x = p^T v0
+        - recorder: Recorder receiving the 'trans' and 'iteration' events
+        - early_stop: dict with 'target' and 'err' (error of the estimates of
+          p_a(i)^T v, eps here), to stop as soon as certified_bound <= target.
+          'bound' and 'iterations' (number done) are written in it
+        - bernstein: adapt the number of samples to each pair (see apx_trans_block)
+    """
     m_hist = []
 
     start_time_x = time.time()
-    x = np.zeros((mdp.nb_s, mdp.nb_a))
-    for i in range(mdp.nb_s):
-        x[i, :] = [mdp.transition[i, a, :].dot(v0) for a in range(mdp.nb_a)]
+    if pool is not None:
+        x = pool.expected_values(v0[:, 0])
+    else:
+        x = mdp.expected_values(v0[:, 0])
 
-    if analyze:
-        print("{} sec to compute x=p^Tv".format(round(time.time() - start_time_x,4)))
+    if recorder is not None:
+        recorder.record('trans', duration=time.time() - start_time_x, m=0, samples=0)
 
     v_prev = v0.copy()
     for l in range(L):
         start_time_l = time.time()
-        v_l, pi_l = apx_val(mdp, v_prev, v0, x, eps, delta / L)
-        v_prev = v_l
+        samples_l = sample_count(mdp, pool)
+        v_l, pi_l = apx_val(mdp, v_prev, v0, x, eps, delta / L, pool=pool, bernstein=bernstein)
+        residual = float(np.max(np.abs(v_l - v_prev)))
+        duration_l = time.time() - start_time_l
+        m = nb_samples(np.max(np.abs(v_prev - v0)), eps, delta / (L * mdp.nb_s * mdp.nb_a))
 
+        if recorder is not None:
+            recorder.record('iteration', l=l, duration=duration_l, m=m,
+                            samples=sample_count(mdp, pool) - samples_l,
+                            residual=residual)
         if analyze:
-            duration_l = time.time() - start_time_l
-            m = int(2 * np.max(np.abs(v_prev - v0))**2 / (eps**2) \
-                * np.log(2 / delta)) + 1
-            print("Iteration l={}, |S||A|*{} iterations of ApxTrans in {} sec".format(
-                l, m, round(duration_l,4)))
             m_hist.append([m, duration_l])
+        v_prev = v_l
+
+        if early_stop is not None and _stop(mdp, early_stop, l, residual,
+                                                 sample_count(mdp, pool) - samples_l):
+            break
 
-    return v_l, pi_l, np.arrray(m_hist)
+    return v_l, pi_l, np.array(m_hist)
@@ -22,7 +22,7 @@ print("mdp:", time.time() - start_time)
 
 print("##### mdp done #####")
 
-from sublinear_randomizedVI import sublinear_time_randomized_VI
+from sublinear_radomizedVI import sublinear_time_randomized_VI
 
 start_time  = time.time()
 v_sub, pi_sub, analysis_sub = sublinear_time_randomized_VI(mdp, eps=0.1, delta=0.1, analyze=True)
@@ -42,4 +42,13 @@ pi_VI, V_VI = run_value_iteration(mdp, eps=0.001)
 
 print("VI time:", time.time() - start_time)
 print("Policy:", pi_VI.T)
-print("Value function", np.linalg.norm(V_VI.T, ord=np.inf))
\ No newline at end of file
+print("Value function", np.linalg.norm(V_VI.T, ord=np.inf))
+print("######## \n")
+
+from linear_programming import LP_constraint_generation_DMDP
+
+start_time  = time.time()
+V_LP, pi_LP = LP_constraint_generation_DMDP(mdp, nb_sweeps=0)
+
+print("LP time (no initial sweep):", time.time() - start_time)
+assert np.max(np.abs(V_LP - V_VI[:, 0])) < 0.01
@@ -2,6 +2,8 @@ import numpy as np
 import math
 
 
+ROUND_RATIO = 8  # Alias_table switches to its sequential pass below 1 small column per ROUND_RATIO large ones
+
 
 class Node:
     """
@@ -119,99 +121,218 @@ class Sampling_tree:
 
 
 
+class Alias_table:
+    """
+    Class designed to sample in constant time from events with discrete probabilities
+    using Walker's alias method, with a vectorized variant of Vose's construction.
+    The table is stored in two flat numpy arrays.
+
+    Context: drawings from a fixed number of events with given probabilities
+    (drop-in for Sampling_tree when the probabilities never change)
+    
+    """
+
+    def __init__(self, probabilities):
+
+        proba = np.asarray(probabilities, dtype=float)
+        self.n = len(proba)
+        self.accept = np.ones(self.n)  # probability to keep the drawn column
+        self.alias = np.arange(self.n)  # event of the column otherwise
+
+        scaled = proba * self.n / np.sum(proba)
+        small = np.flatnonzero(scaled < 1)
+        large = np.flatnonzero(scaled >= 1)
+
+        # each round fills all the small columns at once: the deficits of the small
+        # columns are laid after each other and shared among the large ones. A round
+        # costs O(len(small) + len(large)), so once it would fill only a few columns
+        # the rest is done by the sequential pass, to keep the build in O(n)
+        while len(small) > 0 and len(large) > 0:
+
+            if len(small) * ROUND_RATIO < len(large):
+                self._vose(scaled, small, large)
+                break
+
+            deficit = 1 - scaled[small]
+            donor = np.searchsorted(np.cumsum(scaled[large] - 1), np.cumsum(deficit))
+            np.minimum(donor, len(large) - 1, out=donor)
+
+            self.accept[small] = scaled[small]
+            self.alias[small] = large[donor]
+            scaled[large] -= np.bincount(donor, weights=deficit, minlength=len(large))
+
+            now_small = scaled[large] < 1
+            small = large[now_small]
+            large = large[~now_small]
+
+    def _vose(self, scaled, small, large):
+        """ Sequential Vose construction of the remaining small and large columns """
+
+        scaled = scaled.tolist()
+        small, large = small.tolist(), large.tolist()
+
+        while small and large:
+
+            column, donor = small.pop(), large[-1]
+            self.accept[column] = scaled[column]
+            self.alias[column] = donor
+            scaled[donor] -= 1 - scaled[column]
+            if scaled[donor] < 1:
+                small.append(large.pop())
+
+    def sample(self, n=None):
+        """
+        random event drawing according to input probabilities
+        - n: number of drawings, a single event is returned if None
+        
+        """
+
+        if n is None:
+
+            x = np.random.random()*self.n
+            column = int(x)
+
+            return column if x - column < self.accept[column] else int(self.alias[column])
+
+        x = np.random.random(n)*self.n
+        columns = x.astype(np.int64)
+
+        return np.where(x - columns < self.accept[columns], columns, self.alias[columns])
+
+    def delete_tree(self):
+        """ Kept for compatibility with Sampling_tree """
+
+        self.accept = None
+        self.alias = None
+
+
 class Sampling_tree_with_policy_updates:
     """
-    Class designed to sample efficiently from events with discrete probabilities using
-    a binary tree. Adapted from: "An efficient method for weighted samplingwithout replacement"
+    Class designed to sample efficiently from events with discrete weights using
+    a binary sum tree. Adapted from: "An efficient method for weighted samplingwithout replacement"
     by Wong and Easton.
     
-    this version allows to update the probability of the last visited event with a new probability
+    The tree is an implicit heap stored in one numpy array: node k has children
+    2k and 2k+1, the root is node 1 and the leaves are the last self.size nodes.
+    Weights can be updated by index, one at a time or in bulk, and the last
+    visited event can be updated with a new probability.
     
     """
                  
     def __init__(self, weights):
         
-        self.weights = weights
-        self.sum = sum(weights)
-        self.max_depth = math.ceil(np.log(len(weights))/np.log(2))
+        weights = np.asarray(weights, dtype=float)
+        self.n = len(weights)
+        self.max_depth = max(math.ceil(np.log(self.n)/np.log(2)), 0)
+        self.size = 2**self.max_depth  # number of leaves
         
-        self.root = Node(0, self.max_depth)
+        self.tree = np.zeros(2*self.size)
+        self.tree[self.size:self.size + self.n] = weights
         self.preprocess_tree()
         
-        ### keep track of last path down the three for updates
-        self.last_path = [0]*self.max_depth
         self.last_visit = None
 
-    def add(self, val, node):
+    @property
+    def weights(self):
         
-        if node.L == None and node.depth < self.max_depth:
-            
-            node.L = Node(node.depth + 1, self.max_depth)
-            node.one_more_child_left(self.weights[val])
-            self.add(val, node.L)
+        return self.tree[self.size:self.size + self.n]
+
+    @property
+    def sum(self):
         
-        elif node.L != None and node.L.is_full == False:
-            
-            node.one_more_child_left(self.weights[val])
-            self.add(val, node.L)
+        return self.tree[1]
         
-        elif node.R == None and node.depth < self.max_depth:
-            
-            node.R = Node(node.depth + 1, self.max_depth)
-            node.one_more_child_right(self.weights[val])
-            self.add(val, node.R)
+    def preprocess_tree(self):
+        """
+        bottom-up construction of the inner nodes, one level at a time
         
-        elif node.R != None and node.R.is_full == False:
-            
-            node.one_more_child_right(self.weights[val])
-            self.add(val, node.R)
-            
-        elif node.depth == self.max_depth:
-            
-            node.val = val
-            
-        else:
-            
-            print("one more mysterious case")
+        """
         
-    def preprocess_tree(self):
+        level = self.size // 2
         
-         for state in range(len(self.weights)):
-                
-                self.add(state, self.root)
+        while level >= 1:
+            
+            self.tree[level:2*level] = self.tree[2*level:4*level:2] + self.tree[2*level+1:4*level:2]
+            level //= 2
                  
-    def sample(self):
+    def sample(self, n=None):
         """
-        random event drawing according to input probabilities
+        random event drawing according to input weights
+        - n: number of drawings, a single event is returned if None
+          (only single drawings are registered as last visited event)
         
         """
         
-        x = np.random.random()*self.sum
-        bound = 0
-        node = self.root
+        if n is not None:
+            
+            return self.sample_batch(n)
         
-        #print(x, self.sum)
-        #count = 0
+        x = np.random.random()*self.tree[1]
+        node = 1
         
-        while node.depth < self.max_depth:
+        while node < self.size:
             
-            #count += 1
-            #print(count)
+            left = 2*node
             
-            if x < node.val[0] + bound:
+            if x < self.tree[left] or self.tree[left + 1] <= 0:
                 
-                self.last_path[node.depth] = 0
-                node = node.L
+                node = left
             
             else:
                 
-                self.last_path[node.depth] = 1
-                bound += node.val[0]
-                node = node.R
+                x -= self.tree[left]
+                node = left + 1
         
-        self.last_visit = node.val
+        self.last_visit = node - self.size
         
-        return node.val
+        return self.last_visit
+    
+    def sample_batch(self, n):
+        """
+        n independent drawings, all walking down the tree together
+        
+        """
+        
+        x = np.random.random(n)*self.tree[1]
+        nodes = np.ones(n, dtype=np.int64)
+        
+        for depth in range(self.max_depth):
+            
+            left = 2*nodes
+            go_right = (x >= self.tree[left]) & (self.tree[left + 1] > 0)
+            x -= np.where(go_right, self.tree[left], 0)
+            nodes = left + go_right
+        
+        return nodes - self.size
+    
+    def update(self, index, weight):
+        """
+        set the weight of event index and update its ancestors
+        
+        """
+        
+        node = index + self.size
+        self.tree[node] = weight
+        node //= 2
+        
+        while node >= 1:
+            
+            self.tree[node] = self.tree[2*node] + self.tree[2*node + 1]
+            node //= 2
+    
+    def update_batch(self, indices, weights):
+        """
+        set the weights of several events and update their ancestors level by level
+        
+        """
+        
+        nodes = np.asarray(indices) + self.size
+        self.tree[nodes] = weights
+        
+        for depth in range(self.max_depth):
+            
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
     
     def update_weights(self, new_proba):
         """
@@ -223,26 +344,9 @@ class Sampling_tree_with_policy_updates:
         old_w = self.weights[self.last_visit]
         new_w = new_proba / (1 - new_proba) * (self.sum - old_w)
         
-        node = self.root
-        
-        for i in range(self.max_depth):
-            
-            go_right = self.last_path[i]
-
-            node.val[go_right] += new_w - old_w
-            
-            if go_right == 1:
-                
-                node = node.R
-            
-            else:
-                
-                node = node.L
-        
-        self.weights[self.last_visit] = new_w
-        self.sum += new_w - old_w
+        self.update(self.last_visit, new_w)
         
         
     def delete_tree(self):
         
-        self.root = None
\ No newline at end of file
+        self.tree = None
@@ -1,85 +1,150 @@
 import numpy as np
+import contextlib
 import math
 from tqdm import tqdm
 import time
 
-from Approximate_DMDP.randomized_value_iteration import apx_val, apx_trans
+from Approximate_DMDP.randomized_value_iteration import apx_val, apx_trans_all, \
+    nb_samples, Sample_bank, BANK_SIZE, _stop, _adaptive_phase, _adaptive_report, _bernstein_report, \
+    _warm_start
+from Approximate_DMDP.instrumentation import sample_count, hoeffding_count
 
-def sampled_randomized_VI(mdp, v0, L, eps, delta, analyze=False):
+def sampled_randomized_VI(mdp, v0, L, eps, delta, analyze=False,
+                          reuse_samples=False, bank_size=BANK_SIZE, pool=None, recorder=None,
+                          early_stop=None, bernstein=False):
     """ Sampled Randomized Value Iteration 
+        - reuse_samples: draw the next states of each (i, a) once and reuse them in
+          the L iterations (Sample_bank of at most bank_size bytes). The iterations
+          are then not independent and the delta guarantee does not hold anymore.
+        - pool: Sweep_pool to shard the states across processes
+        - recorder: Recorder receiving the 'trans' and 'iteration' events
+        - early_stop: dict with 'target' and 'err' (error of the estimates of
+          p_a(i)^T v, 2*eps here since x is sampled too), see randomizedVI
+        - bernstein: adapt the number of samples to each pair (see apx_trans_block)
     """
     m_hist = []
     m_x_hist = []
+    bank = Sample_bank(mdp, bank_size) if reuse_samples else None
         
 
     # Sample to obtain x approximation of p.v0
     time_start_x = time.time()
-    x = np.zeros((mdp.nb_s, mdp.nb_a))
-    for i in range(mdp.nb_s):
-        for a in range(mdp.nb_a):
-            x[i, a] = apx_trans(mdp, v0, np.max(v0), i, a, eps, delta)
+    if recorder is not None:
+        samples_x = sample_count(mdp, pool)
+    x = apx_trans_all(mdp, v0, np.max(np.abs(v0)), eps, delta, bank=bank, pool=pool,
+                      bernstein=bernstein)
 
+    duration_x = time.time() - time_start_x
+    m_x = nb_samples(np.max(np.abs(v0)), eps, delta)
+    if recorder is not None:
+        recorder.record('trans', duration=duration_x, m=m_x,
+                        samples=sample_count(mdp, pool) - samples_x)
     if analyze:
-        duration_x = time.time() - time_start_x
-        m_x = int(2 * np.max(v0)**2 / (eps**2) * np.log(2 / delta)) + 1
         m_x_hist.append([m_x, duration_x])
-        print("{} sec to compute x=p^Tv by doing {} iterations of ApxTrans".format(round(duration_x,4), m_x))
-        print("norm inf v =", np.linalg.norm(v0, ord=np.inf))
-            
+
     v_prev = v0.copy()
     for l in range(L):
         start_time_l = time.time()
-        v_l, pi_l = apx_val(mdp, v_prev, v0, x, eps, delta / L)
-        v_prev = v_l
+        samples_l = sample_count(mdp, pool)
+        v_l, pi_l = apx_val(mdp, v_prev, v0, x, eps, delta / L, bank=bank, pool=pool,
+                            bernstein=bernstein)
+        residual = float(np.max(np.abs(v_l - v_prev)))
+        duration_l = time.time() - start_time_l
+        m = nb_samples(np.max(np.abs(v_prev - v0)), eps, delta / (L * mdp.nb_s * mdp.nb_a))
 
+        if recorder is not None:
+            recorder.record('iteration', l=l, duration=duration_l, m=m,
+                            samples=sample_count(mdp, pool) - samples_l,
+                            residual=residual)
         if analyze:
-            duration_l = time.time() - start_time_l
-            m = int(2 * np.max(np.abs(v_prev - v0))**2 / (eps**2) \
-                * np.log(2 / delta)) + 1
-            m_hist.append(m)
-            print("Iteration l={}, |S||A|*{} iterations of ApxTrans in {} sec, because |v_prev - v0|_inf ={}".format(
-                l, m, round(duration_l,4), np.max(np.abs(v_prev - v0))))
             m_hist.append([m, duration_l])
+        v_prev = v_l
+
+        if early_stop is not None and _stop(mdp, early_stop, l, residual,
+                                                 sample_count(mdp, pool) - samples_l):
+            break
 
     return v_l, pi_l, m_hist, m_x_hist
 
-def sublinear_time_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0, show_time=False):
+def sublinear_time_randomized_VI(mdp, eps, delta, analyze=False, v0_value=0, show_time=False,
+                                 reuse_samples=False, bank_size=BANK_SIZE, pool=None,
+                                 recorder=None, adaptive=False, v_init=None, err_init=None,
+                                 bernstein=False):
     """ Sublinear Time Randomized Value Iteration
         Gives an eps-approximate value function with probability 1 - delta
         - analyze: to plot the convergence of the value function
+        - reuse_samples: reuse the samples within each outer iteration
+          (see sampled_randomized_VI, the delta guarantee does not hold anymore)
+        - pool: Sweep_pool to shard the states across processes
+        - recorder: Recorder receiving the timings, samples drawn and residuals
+          of every iteration (see instrumentation)
+        - adaptive: stop the inner loops and skip the outer iterations on a
+          certified bound (see _adaptive_phase), reported in analysis['adaptive']
+        - v_init, err_init: warm start (see _warm_start)
+        - bernstein: adapt the number of samples of each pair (i, a), reported
+          in analysis['bernstein'] (see _bernstein_report)
     """
-    K = math.log(mdp.M / (eps * (1 - mdp.gamma)), 2)
-    K = int(K) + 1
+    v0, eps_prev = _warm_start(mdp, v0_value, v_init, err_init)
+
+    K = math.log(eps_prev / eps, 2)
+    K = max(int(K) + 1, 1)
     L = 1. / (1 - mdp.gamma) * math.log(4. / (1 - mdp.gamma))
     L = int(L) + 1
-
-    v0 = np.zeros((mdp.nb_s, 1)) + v0_value
     v_prev = v0
-    eps_prev = mdp.M / (1 - mdp.gamma)
 
     analysis = {}  # To keep convergence informations
     if analyze: # Keep history of convergence
-        print("K={} principal iterations, with L={} iterations in each one".format(K, L))
-        # Information about the problem
         analysis['m_hist'] = {}
         analysis['m_x_hist'] = {}
         analysis['duration_iter_k'] = {}
 
+    if recorder is not None:
+        recorder.record('setup', K=K, L=L, eps=eps, delta=delta, M=mdp.M,
+                        nb_s=mdp.nb_s, nb_a=mdp.nb_a, gamma=mdp.gamma)
+
+    if adaptive:
+        analysis['adaptive'] = {'outer_iterations': 0, 'inner_iterations': 0,
+                                'skipped_outer': 0, 'samples': 0}
+    samples_start, hoeffding_start = sample_count(mdp, pool), hoeffding_count(mdp, pool)
+    skip = 0
+
     for k in tqdm(range(K)):
         start_time_k = time.time()
         eps_k = eps_prev * 0.5
+        if skip > 0:  # v_prev is already certified eps_k-approximate
+            skip -= 1
+            eps_prev = eps_k
+            continue
+
         eps_func = (1 - mdp.gamma) * eps_k / (4 * mdp.gamma)
-        v_k, pi_k, m_hist, m_x_hist = sampled_randomized_VI(mdp, v_prev, L, eps_func, 
-                                 delta / K, analyze)
+        early_stop = {'target': eps_k, 'err': 2 * eps_func} if adaptive else None
+        samples_k = sample_count(mdp, pool)
+        with (recorder.scope(k=k) if recorder else contextlib.nullcontext()):
+            v_k, pi_k, m_hist, m_x_hist = sampled_randomized_VI(mdp, v_prev, L, eps_func,
+                                     delta / K, analyze, reuse_samples, bank_size, pool,
+                                     recorder, early_stop, bernstein)
+        if recorder is not None:
+            recorder.record('outer', k=k, duration=time.time() - start_time_k, eps_k=eps_k,
+                            samples=sample_count(mdp, pool) - samples_k)
 
         if analyze:
-            duration = time.time() - start_time_k
-            print("Iteration k={}: {}sec".format(k, round(duration,4)))
             analysis['m_hist'][k] = m_hist
             analysis['m_x_hist'][k] = m_x_hist
-            analysis['duration_iter_k'][K] = duration
+            analysis['duration_iter_k'][k] = time.time() - start_time_k
 
         eps_prev = eps_k
         v_prev = v_k
 
+        if adaptive:
+            skip, done = _adaptive_phase(analysis['adaptive'], early_stop, eps_k, eps,
+                                         sample_count(mdp, pool) - samples_k)
+            if done:
+                break
+
+    if adaptive:
+        _adaptive_report(analysis['adaptive'], K, L)
+
+    if bernstein:
+        analysis['bernstein'] = _bernstein_report(mdp, pool, samples_start, hoeffding_start)
+
     return v_k, pi_k, analysis
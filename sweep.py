@@ -0,0 +1,162 @@
+import numpy as np
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import time
+
+from Approximate_DMDP.benchmark import make_DMDP
+from Approximate_DMDP.high_precision_randomized_VI import high_precision_randomized_VI
+
+
+INDEX = 'index.jsonl'
+MDP_PARAMS = ('family', 'nb_s', 'nb_a', 'gamma')  # Grid parameters defining the DMDP
+MDP_DEFAULTS = {'family': 'dense', 'nb_s': 10, 'nb_a': 4, 'gamma': 0.7}
+
+_sweep = {}  # Solver and DMDP factory of the sweep, inherited by the forked workers
+
+
+def mdp_hash(mdp):
+    """ Hash of the content of a DMDP: sizes, gamma, rewards and transitions """
+    h = hashlib.sha256(json.dumps([mdp.nb_s, mdp.nb_a, float(mdp.gamma)]).encode())
+    if mdp.is_sparse:
+        arrays = [mdp.rewards, mdp.transition.indptr, mdp.transition.indices, mdp.transition.probs]
+    else:
+        arrays = [mdp.rewards, mdp.transition]
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(array.dtype.str.encode())
+        h.update(memoryview(array.reshape(-1)).cast('B'))
+    return h.hexdigest()
+
+
+def solver_version(solver):
+    """ Hash of the source of the module of solver and of the modules of this
+        package it imports from, so that editing the solver invalidates the cache """
+    module = inspect.getmodule(solver)
+    package = module.__name__.split('.')[0]
+    modules = {module.__name__: module}
+    for obj in vars(module).values():
+        dep = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+        if dep is not None and dep.__name__.split('.')[0] == package:
+            modules[dep.__name__] = dep
+
+    h = hashlib.sha256()
+    for name in sorted(modules):
+        h.update(name.encode())
+        h.update(inspect.getsource(modules[name]).encode())
+    return h.hexdigest()
+
+
+def read_index(cache_dir):
+    """ Metadata of the cached results, by key """
+    index = {}
+    name = os.path.join(cache_dir, INDEX)
+    if os.path.exists(name):
+        with open(name) as f:
+            for line in f:
+                meta = json.loads(line)
+                index[meta['key']] = meta
+    return index
+
+
+def load_result(cache_dir, key):
+    """ Result of a cell: {'result': output of the solver, 'time': duration} """
+    with open(os.path.join(cache_dir, key + '.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def _m_summary(result):
+    """ Number of samples m of each inner iteration, by outer iteration k,
+        taken from the analysis dict returned last by the solver """
+    analysis = result[-1] if isinstance(result, tuple) else None
+    if not isinstance(analysis, dict) or not analysis.get('m_hist'):
+        return None
+    m_hist = analysis['m_hist']
+    m_hist = m_hist.items() if isinstance(m_hist, dict) else enumerate(m_hist)
+    return {str(k): [float(np.ravel(m)[0]) for m in hist] for k, hist in m_hist}
+
+
+def _plain(value):
+    """ Python value of a numpy scalar or array (as json needs), value otherwise """
+    return value.tolist() if isinstance(value, (np.generic, np.ndarray)) else value
+
+
+def _run_cell(cell):
+    """ Build the DMDP of a cell and run the solver unless the result is cached
+        - return (key, metadata or None if cached) """
+    mdp_args, solver_args, rep, seed = cell
+    mdp = _sweep['make_mdp'](**mdp_args, seed=seed)
+    content = json.dumps({'mdp': mdp_hash(mdp), 'solver': _sweep['version'],
+                          'args': solver_args, 'seed': seed}, sort_keys=True)
+    key = hashlib.sha256(content.encode()).hexdigest()
+    if key in _sweep['cached']:
+        return key, None
+
+    np.random.seed(seed)
+    mdp.nb_samples = 0
+    start_time = time.time()
+    result = _sweep['solver'](mdp, **solver_args)
+    duration = time.time() - start_time
+
+    name = os.path.join(_sweep['cache_dir'], key + '.pkl')
+    with open(name + '.tmp', 'wb') as f:
+        pickle.dump({'result': result, 'time': duration}, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(name + '.tmp', name)
+
+    meta = dict(mdp_args, **solver_args)
+    meta.update({'key': key, 'solver': _sweep['solver'].__name__, 'rep': rep, 'seed': seed,
+                 'time': duration, 'samples': int(mdp.nb_samples), 'm_hist': _m_summary(result)})
+    return key, meta
+
+
+def run_sweep(grid, solver=high_precision_randomized_VI, solver_args=None, mdp_args=None,
+              repetitions=1, seed=0, cache_dir='sweep_cache', n_workers=None, make_mdp=make_DMDP):
+    """ Run solver on every cell of a grid, in parallel processes, with a cache
+        - grid: dict {parameter: list of values}, the parameters of MDP_PARAMS
+          define the DMDP (made by make_mdp(family, nb_s, nb_a, gamma, seed)) and
+          the other ones (eps, delta, v0_value...) are passed to the solver
+        - solver_args, mdp_args: fixed arguments, MDP_DEFAULTS for the DMDP
+        - repetitions: number of DMDPs per cell, the r-th one (and the random
+          state of its solver) is drawn with seed + r
+        - each result is stored in cache_dir under a hash of the DMDP content,
+          solver_version(solver), the solver arguments and the seed, with its
+          metadata appended to cache_dir/index.jsonl: only the cells whose key is
+          not in the index are computed
+        - return the list of the metadata of all the cells of the grid """
+    os.makedirs(cache_dir, exist_ok=True)
+    index = read_index(cache_dir)
+
+    params = list(grid)
+    cells = []
+    for values in itertools.product(*[grid[p] for p in params]):
+        cell_mdp = dict(MDP_DEFAULTS, **(mdp_args or {}))
+        cell_solver = dict(solver_args or {})
+        for p, value in zip(params, values):
+            (cell_mdp if p in MDP_PARAMS else cell_solver)[p] = value
+        cell_mdp = {p: _plain(value) for p, value in cell_mdp.items()}
+        cell_solver = {p: _plain(value) for p, value in cell_solver.items()}
+        for rep in range(repetitions):
+            cells.append((cell_mdp, cell_solver, rep, seed + rep))
+
+    _sweep.update(solver=solver, make_mdp=make_mdp, cache_dir=cache_dir,
+                  version=solver_version(solver), cached=set(index))
+    keys = []
+    with multiprocessing.get_context('fork').Pool(n_workers) as pool, \
+         open(os.path.join(cache_dir, INDEX), 'a') as f:
+        for key, meta in pool.imap(_run_cell, cells):
+            if meta is not None:
+                f.write(json.dumps(meta) + '\n')
+                f.flush()
+                index[key] = meta
+            keys.append(key)
+
+    return [index[key] for key in keys]
+
+
+def select(results, **fixed):
+    """ Metadata of the cells whose parameters have the given values """
+    return [meta for meta in results if all(meta.get(p) == value for p, value in fixed.items())]
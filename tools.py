@@ -3,6 +3,7 @@ import pickle
 import matplotlib.pyplot as plt
 
 from Approximate_DMDP.DMDP_class import create_random_DMDP
+from Approximate_DMDP.sweep import read_index, select
 
 
 def save_obj(obj, name):
@@ -57,3 +58,23 @@ def analyze_m(analys, param):
     
     return m_hist_list
 
+
+def load_sweep_times(cache_dir, param, **fixed):
+    """ Execution times of a sweep by value of param, {value: [times]}, read from
+        the index of cache_dir (the results themselves are not loaded)
+        - fixed: values of the other parameters of the selected cells """
+    times = {}
+    for meta in select(read_index(cache_dir).values(), **fixed):
+        times.setdefault(meta[param], []).append(meta['time'])
+    return dict(sorted(times.items()))
+
+
+def load_sweep_analyses(cache_dir, param, **fixed):
+    """ Number of samples m of the iterations of a sweep by value of param,
+        {value: [{'m_hist': {k: [m]}}]} as expected by analyze_m """
+    analyses = {}
+    for meta in select(read_index(cache_dir).values(), **fixed):
+        if meta['m_hist'] is not None:
+            m_hist = {int(k): m for k, m in meta['m_hist'].items()}
+            analyses.setdefault(meta[param], []).append({'m_hist': m_hist})
+    return dict(sorted(analyses.items()))
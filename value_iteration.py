@@ -1,16 +1,67 @@
 import numpy as np
+import heapq
 
 
-def run_value_iteration_while(mdp, eps=0.01, keep_history=False, iter_max=500):
+BLOCK_SIZE = 1024  # Number of states backed up together by the vectorized backend
+
+
+def bellman_backup(mdp, V, block_size=BLOCK_SIZE, pool=None):
+    """ One synchronous Bellman sweep Q = R + gamma*P.V, max over actions
+        - states are processed by blocks of block_size to bound memory,
+          or sharded across the processes of the Sweep_pool pool
+        - return the new value function and the greedy policy (nb_s x 1) """
+    n = mdp.nb_s
+    V_new = np.zeros((n, 1))
+    pi = np.zeros((n, 1), dtype=mdp.dtypes['policy'])
+
+    if pool is not None:
+        Q = mdp.rewards + mdp.gamma * pool.expected_values(V[:, 0])
+        V_new[:, 0] = np.max(Q, axis=1)
+        pi[:, 0] = np.argmax(Q, axis=1)
+        return V_new, pi
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        Q = mdp.rewards[start:stop] \
+            + mdp.gamma * mdp.expected_values(V[:, 0], start, stop)
+        V_new[start:stop, 0] = np.max(Q, axis=1)
+        pi[start:stop, 0] = np.argmax(Q, axis=1)
+
+    return V_new, pi
+
+
+def initial_error(mdp, v_init=None):
+    """ Bound on |v_init - V*|_inf when nothing more is known: M/(1 - gamma) from 0
+        (V* is in [-M/(1 - gamma), M/(1 - gamma)]), plus |v_init|_inf otherwise """
+    err = mdp.M / (1 - mdp.gamma)
+    return err if v_init is None else err + np.max(np.abs(v_init))
+
+
+def _check_backend(backend):
+    if backend not in ('vectorized', 'loop'):
+        raise ValueError("Unknown backend '{}', expected 'vectorized' or 'loop'".format(backend))
+
+
+def run_value_iteration_while(mdp, eps=0.01, keep_history=False, iter_max=500,
+                              backend='vectorized', block_size=BLOCK_SIZE, pool=None,
+                              v_init=None):
     """ Value iteration of a MDP to find the optimal policy and its evaluation V
-        keep_history -> to keep the convergence history and plot it"""
+        keep_history -> to keep the convergence history and plot it
+        backend -> 'vectorized' (one batched backup per sweep) or 'loop'
+                   (state by state, kept for cross-checking)
+        pool -> Sweep_pool to run the vectorized sweeps across processes
+        v_init -> initial value function (random by default)"""
+    _check_backend(backend)
     n = mdp.nb_s
     a = mdp.nb_a
     Z = np.zeros((a, 1))  # Intermediary values to maximise
-    pi = np.zeros((n, 1))  # Policy
+    pi = np.zeros((n, 1), dtype=mdp.dtypes['policy'])  # Policy
     nb_iter = 0
     
-    V = np.random.random((n, 1))
+    if v_init is None:
+        V = np.random.random((n, 1))
+    else:
+        V = np.array(v_init, dtype=float).reshape(n, 1)
     V_prec = V + eps + 1
     if keep_history:
         V_hist = [V]
@@ -18,10 +69,17 @@ def run_value_iteration_while(mdp, eps=0.01, keep_history=False, iter_max=500):
     while nb_iter < iter_max and np.linalg.norm(V - V_prec) > eps:
         nb_iter += 1
         V_prec = V.copy()
+
+        if backend == 'vectorized':
+            V, pi = bellman_backup(mdp, V_prec, block_size, pool)
+            if keep_history:
+                V_hist.append(V.copy())
+            continue
+
         for state in range(n):
             for action in range(a):
-                esp = [V_prec[y] * mdp.transition[state, action, y]
-                       for y in range(n)]
+                esp = [V_prec[y] * p
+                       for y, p in zip(*mdp.successors(state, action))]
                 Z[action] = mdp.rewards[state, action] + mdp.gamma * sum(esp)
             V[state] = np.max(Z)
             pi[state] = np.argmax(Z)
@@ -38,28 +96,43 @@ def run_value_iteration_while(mdp, eps=0.01, keep_history=False, iter_max=500):
     else:
         return V, pi
 
-def run_value_iteration(mdp, eps, keep_history=False, iter_max=500):
+def run_value_iteration(mdp, eps, keep_history=False, iter_max=500,
+                        backend='vectorized', block_size=BLOCK_SIZE, pool=None,
+                        v_init=None, err_init=None):
     """ Value iteration of a MDP to find the optimal policy and its evaluation V
         keep_history -> to keep the convergence history and plot it
+        backend -> 'vectorized' (one batched backup per sweep) or 'loop'
+                   (state by state, kept for cross-checking)
+        pool -> Sweep_pool to run the vectorized sweeps across processes
+        v_init, err_init -> initial value function (0 by default) and a bound on
+                            |v_init - V*|_inf (see initial_error by default)
 
         Run using a number of iteration depending on eps (the precision)"""
-    K = np.log(eps*(1 - mdp.gamma)/mdp.M) / np.log(mdp.gamma)
-    K = int(K) + 1
+    _check_backend(backend)
+    err_init = initial_error(mdp, v_init) if err_init is None else err_init
+    K = np.log(eps / err_init) / np.log(mdp.gamma)
+    K = max(int(K) + 1, 1)
 
     n = mdp.nb_s
     a = mdp.nb_a
     Z = np.zeros((a, 1))  # Intermediary values to maximise
-    pi = np.zeros((n, 1))  # Policy
+    pi = np.zeros((n, 1), dtype=mdp.dtypes['policy'])  # Policy
     
-    V = np.zeros((n, 1))
+    V = np.zeros((n, 1)) if v_init is None else np.array(v_init, dtype=float).reshape(n, 1)
     if keep_history:
         V_hist = [V]
     
     for k in range(K):
+        if backend == 'vectorized':
+            V, pi = bellman_backup(mdp, V, block_size, pool)
+            if keep_history:
+                V_hist.append(V.copy())
+            continue
+
         for state in range(n):
             for action in range(a):
-                esp = [V[y] * mdp.transition[state, action, y]
-                       for y in range(n)]
+                esp = [V[y] * p
+                       for y, p in zip(*mdp.successors(state, action))]
                 Z[action] = mdp.rewards[state, action] + mdp.gamma * sum(esp)
             V[state] = np.max(Z)
             pi[state] = np.argmax(Z)
@@ -70,4 +143,112 @@ def run_value_iteration(mdp, eps, keep_history=False, iter_max=500):
     if keep_history:
         return pi, V, V_hist
     else:
-        return pi, np.array(V)
\ No newline at end of file
+        return pi, np.array(V)
+
+
+def prioritized_backups(mdp, V, pi, res, tol, states=None):
+    """ Bellman backups of single states (Gauss-Seidel), by decreasing bound on
+        their residual, until every bound is at most tol
+        - V, pi: value function and policy (nb_s x 1), updated in place
+        - res: upper bounds on |T(V) - V| by state, updated in place: backing up
+          s by d adds gamma*p*d to the bound of each predecessor i of s
+          (p = max_a p_a(i)[s], see DMDP.predecessors)
+        - states: the only states whose bound may exceed tol, all by default
+        - the rows of s are read in place from the transitions, so that the work
+          only depends on the states backed up
+        - return the number of backups """
+    nb_a, gamma = mdp.nb_a, mdp.gamma
+    P = mdp.transition
+    v = V[:, 0]
+    states = np.arange(mdp.nb_s) if states is None else np.unique(states)
+    states = states[res[states] > tol]
+    heap = list(zip((-res[states]).tolist(), states.tolist()))
+    heapq.heapify(heap)
+    nb_backups = 0
+
+    while heap:
+        r, s = heapq.heappop(heap)
+        if -r != res[s]:  # the bound of s changed since it was queued
+            continue
+        if mdp.is_sparse:
+            rows = P.indptr[s * nb_a:(s + 1) * nb_a + 1]
+            Q = mdp.rewards[s] + gamma * np.add.reduceat(
+                P.probs[rows[0]:rows[-1]] * v[P.indices[rows[0]:rows[-1]]], rows[:-1] - rows[0])
+        else:
+            Q = mdp.rewards[s] + gamma * P[s].dot(v)
+        a = Q.argmax()
+        d = abs(Q[a] - v[s])
+        v[s], pi[s, 0] = Q[a], a
+        res[s] = 0
+        nb_backups += 1
+        if d == 0:
+            continue
+
+        pred, probs = mdp.predecessors(s)
+        res[pred] += gamma * d * probs
+        for i, r in zip(pred.tolist(), res[pred].tolist()):
+            if r > tol:
+                heapq.heappush(heap, (-r, i))
+
+    return nb_backups
+
+
+def run_prioritized_value_iteration(mdp, eps, v_init=None, analyze=False):
+    """ Prioritized sweeping: asynchronous value iteration backing up first the
+        states with the largest residual, and only the states one of whose
+        successors changed (see prioritized_backups)
+        - one synchronous sweep gives the exact residuals of v_init (0 by default),
+          then the backups go on until |T(V) - V|_inf <= eps*(1 - gamma), so that
+          |V - V*|_inf <= eps, and a last sweep gives the greedy policy
+        - the work follows the states reached by the changes of V: on sparse,
+          locally connected DMDPs it is far below the K full sweeps of
+          run_value_iteration
+        - analyze: also return the number of single-state backups, the 2*nb_s
+          of the two sweeps included
+        - return pi, V as run_value_iteration """
+    n = mdp.nb_s
+    V = np.zeros((n, 1)) if v_init is None else np.array(v_init, dtype=float).reshape(n, 1)
+    TV, pi = bellman_backup(mdp, V)
+    res = np.abs(TV - V)[:, 0]
+
+    nb_backups = 2 * n + prioritized_backups(mdp, V, pi, res, eps * (1 - mdp.gamma))
+    V, pi = bellman_backup(mdp, V)
+
+    if analyze:
+        return pi, V, nb_backups
+    return pi, V
+
+
+def run_batched_value_iteration(bmdp, eps, v_init=None, err_init=None, analyze=False):
+    """ Value iteration of the B instances of a Batched_DMDP together: each
+        sweep is one batched product over the instances still active
+        - instance b stops after its own K_b = log(eps/err_init)/log(gamma_b)
+          sweeps (err_init: see initial_error), or as soon as
+          gamma*|V - V_prev|_inf/(1 - gamma) <= eps certifies |V - V*|_inf <= eps
+        - v_init: initial value functions, size B x nb_s (0 by default)
+        - analyze: also return the number of sweeps of each instance
+        - return pi, V of size B x nb_s x 1 """
+    B, n, gamma = bmdp.nb_b, bmdp.nb_s, bmdp.gamma
+    V = np.zeros((B, n)) if v_init is None else np.array(v_init, dtype=float).reshape(B, n)
+    if err_init is None:
+        err_init = bmdp.M / (1 - gamma) + np.max(np.abs(V), axis=1)
+    K = np.maximum(np.log(eps / err_init) / np.log(gamma), 0).astype(int) + 1
+    pi = np.zeros((B, n), dtype=bmdp.dtypes['policy'])
+    nb_iter = np.zeros(B, dtype=int)
+    active = np.ones(B, dtype=bool)
+
+    for k in range(np.max(K)):
+        active &= k < K
+        if not np.any(active):
+            break
+        g = gamma[active, None, None]
+        Q = bmdp.rewards[active] + g * bmdp.expected_values(V, active)
+        V_new = np.max(Q, axis=2)
+        residual = np.max(np.abs(V_new - V[active]), axis=1)
+        V[active], pi[active] = V_new, np.argmax(Q, axis=2)
+        nb_iter[active] += 1
+        active[active] = gamma[active] * residual / (1 - gamma[active]) > eps
+
+    if analyze:
+        return pi[:, :, None], V[:, :, None], nb_iter
+    return pi[:, :, None], V[:, :, None]